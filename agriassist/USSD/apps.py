@@ -3,3 +3,18 @@ from django.apps import AppConfig
 
 class UssdConfig(AppConfig):
     name = 'agriassist.USSD'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+
+        from . import signals  # noqa: F401
+        from .instrumentation import instrument_connection
+        from .router import get_flow_router
+
+        # builds the flows served, which makes the state ids stored in
+        # UssdSessionState decodable, and fails early on a broken flow
+        get_flow_router()
+
+        if settings.USSD_METRICS_SAMPLE_RATE:
+            connection_created.connect(instrument_connection)
@@ -0,0 +1,75 @@
+""" precomputed seat availability per booking date"""
+
+from datetime import date
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .constants import TIME_SLOTS
+from .models import SlotCapacity
+
+
+class AvailabilityIndex:
+    """
+    Seats left per time slot, one cache entry per booking date
+
+    The entry is rewritten whenever the capacity ledger of its date
+    changes (see capacity.py), so the slot screen costs a single key
+    lookup. It only drives what callers are shown: seats are still taken
+    against the ledger itself, so a stale entry can never overbook.
+    """
+
+    key_prefix = 'ussd:slots:'
+
+    def __init__(self, alias='ussd'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, booking_date):
+        if isinstance(booking_date, date):
+            booking_date = booking_date.isoformat()
+        return self.key_prefix + booking_date
+
+    def compute(self, booking_date):
+        """
+        Read the seats left of a date from the ledger
+
+        Returns:
+            dict: time slot value -> seats left
+        """
+        seats = {time_slot: settings.USSD_SLOT_CAPACITY for time_slot, _ in TIME_SLOTS}
+        for time_slot, capacity, reserved in SlotCapacity.objects.filter(
+            booking_date=booking_date
+        ).values_list('time_slot', 'capacity', 'reserved'):
+            seats[time_slot] = capacity - reserved
+        return seats
+
+    def get(self, booking_date):
+        seats = self.cache.get(self.key(booking_date))
+        if seats is None:
+            seats = self.refresh(booking_date)
+        return seats
+
+    async def aget(self, booking_date):
+        seats = await self.cache.aget(self.key(booking_date))
+        if seats is None:
+            seats = await sync_to_async(self.refresh)(booking_date)
+        return seats
+
+    def refresh(self, booking_date):
+        seats = self.compute(booking_date)
+        self.cache.set(self.key(booking_date), seats, settings.USSD_AVAILABILITY_TIMEOUT)
+        return seats
+
+    def set_many(self, seats_by_date):
+        self.cache.set_many(
+            {self.key(booking_date): seats for booking_date, seats in seats_by_date.items()},
+            settings.USSD_AVAILABILITY_TIMEOUT,
+        )
+
+
+availability_index = AvailabilityIndex()
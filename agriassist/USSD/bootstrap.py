@@ -0,0 +1,177 @@
+""" resolving the user, session and state of a hop in one round-trip"""
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, connection
+from django.utils import timezone
+
+from .models import UssdSession, UssdSessionState, UssdUser
+
+USER_FIELDS = ['id', 'phone_number', 'first_name', 'last_name']
+SESSION_FIELDS = ['id', 'session_id', 'user_id', 'service_code', 'is_active', 'started_at', 'ended_at']
+STATE_FIELDS = ['id', 'current_menu', 'temp_data']
+
+# Each "found" CTE reads the existing row and the matching "new" CTE only
+# inserts when it is missing, so exactly one of the two returns a row.
+# ON CONFLICT DO NOTHING covers a concurrent insert of the same key, in
+# which case neither does and the caller falls back to the ORM.
+USER_CTES = """
+    found_user AS (
+        SELECT {user_columns} FROM {user_table} WHERE phone_number = %(phone_number)s
+    ),
+    new_user AS (
+        INSERT INTO {user_table} (phone_number, first_name, last_name, created_at, updated_at)
+        SELECT %(phone_number)s, '', '', %(now)s, %(now)s
+        WHERE NOT EXISTS (SELECT 1 FROM found_user)
+        ON CONFLICT (phone_number) DO NOTHING
+        RETURNING {user_columns}
+    ),
+    the_user AS (
+        SELECT * FROM found_user UNION ALL SELECT * FROM new_user
+    ),"""
+
+KNOWN_USER_CTE = """
+    the_user AS (
+        SELECT %(user_id)s::bigint AS id
+    ),"""
+
+BOOTSTRAP_SQL = """
+WITH {user_ctes}
+    found_session AS (
+        SELECT {session_columns} FROM {session_table} WHERE session_id = %(session_id)s
+    ),
+    new_session AS (
+        INSERT INTO {session_table} (session_id, user_id, service_code, is_active, started_at)
+        SELECT %(session_id)s, the_user.id, %(service_code)s, true, %(now)s FROM the_user
+        WHERE NOT EXISTS (SELECT 1 FROM found_session)
+        ON CONFLICT (session_id) DO NOTHING
+        RETURNING {session_columns}
+    ),
+    the_session AS (
+        SELECT * FROM found_session UNION ALL SELECT * FROM new_session
+    )
+SELECT {select_columns}
+FROM the_session
+CROSS JOIN the_user
+LEFT JOIN {state_table} AS hop_state ON hop_state.session_id = the_session.id
+"""
+
+
+def _columns(fields, table=None):
+    qn = connection.ops.quote_name
+    return ', '.join(f"{table}.{qn(name)}" if table else qn(name) for name in fields)
+
+
+def _load(model, fields, values):
+    """
+    Build an instance from raw column values, applying the field
+    converters the ORM would (JSON decoding in particular)
+    """
+    converted = []
+    for name, value in zip(fields, values):
+        field = model._meta.get_field(name)
+        for converter in field.get_db_converters(connection):
+            value = converter(value, field, connection)
+        converted.append(value)
+    return model.from_db(connection.alias, fields, converted)
+
+
+def _bootstrap_sql(phone_number, session_id, service_code, user):
+    """
+    Postgres: resolve or create the user and the session and fetch the
+    state in a single statement
+
+    Returns:
+        tuple: (user, session, state), or None if a concurrent hop
+        inserted the same user or session first
+    """
+    qn = connection.ops.quote_name
+    user_columns = USER_FIELDS if user is None else ['id']
+    sql = BOOTSTRAP_SQL.format(
+        user_ctes=(USER_CTES if user is None else KNOWN_USER_CTE).format(
+            user_table=qn(UssdUser._meta.db_table),
+            user_columns=_columns(USER_FIELDS),
+        ),
+        session_table=qn(UssdSession._meta.db_table),
+        state_table=qn(UssdSessionState._meta.db_table),
+        session_columns=_columns(SESSION_FIELDS),
+        select_columns=', '.join([
+            _columns(user_columns, 'the_user'),
+            _columns(SESSION_FIELDS, 'the_session'),
+            _columns(STATE_FIELDS, 'hop_state'),
+        ]),
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {
+            'phone_number': phone_number,
+            'user_id': None if user is None else user.pk,
+            'session_id': session_id,
+            'service_code': service_code,
+            'now': timezone.now(),
+        })
+        row = cursor.fetchone()
+    if row is None:
+        return None
+
+    if user is None:
+        user = _load(UssdUser, USER_FIELDS, row[:len(USER_FIELDS)])
+    row = row[len(user_columns):]
+    session = _load(UssdSession, SESSION_FIELDS, row[:len(SESSION_FIELDS)])
+    row = row[len(SESSION_FIELDS):]
+    session.user = user
+
+    state = None
+    if row[0] is not None:
+        state = _load(UssdSessionState, STATE_FIELDS, row)
+        state.session = session
+    return user, session, state
+
+
+def _bootstrap_orm(phone_number, session_id, service_code, user):
+    """
+    Any other database: one query when the session exists, otherwise its
+    insert (plus the user's lookup when it was not cached)
+    """
+    session = UssdSession.objects.select_related('user', 'state').filter(session_id=session_id).first()
+
+    if session is None:
+        if user is None:
+            user, _ = UssdUser.objects.get_or_create(phone_number=phone_number)
+        try:
+            session = UssdSession.objects.create(
+                session_id=session_id, user=user, service_code=service_code, is_active=True
+            )
+            return user, session, None
+        except IntegrityError:
+            # a retried hop inserted the session first
+            session = UssdSession.objects.select_related('user', 'state').get(session_id=session_id)
+
+    try:
+        state = session.state
+    except UssdSessionState.DoesNotExist:
+        state = None
+    if user is not None:
+        session.user = user
+    return session.user, session, state
+
+
+def bootstrap(phone_number, session_id, service_code, user=None):
+    """
+    Resolve the user, session and stored state of a hop, creating the
+    user and session when they do not exist yet
+
+    Pass `user` when it is already known (e.g. from the profile cache) to
+    skip its lookup.
+
+    Returns:
+        tuple: (user, session, state); state is None until the session
+        has been persisted with one
+    """
+    if connection.vendor == 'postgresql':
+        result = _bootstrap_sql(phone_number, session_id, service_code, user)
+        if result is not None:
+            return result
+    return _bootstrap_orm(phone_number, session_id, service_code, user)
+
+
+abootstrap = sync_to_async(bootstrap)
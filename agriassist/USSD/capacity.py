@@ -0,0 +1,282 @@
+""" time slot capacity and seat reservation"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .availability import availability_index
+from .constants import CANCELLED, TIME_SLOTS
+from .models import SlotCapacity, SlotHold, UssdBooking
+
+
+def _changed(booking_date):
+    """
+    Refresh the availability index of a date once the change is committed
+    """
+    transaction.on_commit(lambda: availability_index.refresh(booking_date))
+
+
+def _take_seats(booking_date, time_slot, party_size):
+    """
+    Reserve seats with a single conditional UPDATE on the slot's ledger row
+
+    Only that row is locked, so confirmations for different slots never
+    wait on each other and the bookings table is not involved at all.
+    """
+    taken = SlotCapacity.objects.filter(
+        booking_date=booking_date,
+        time_slot=time_slot,
+        reserved__lte=F('capacity') - party_size,
+    ).update(reserved=F('reserved') + party_size)
+    if taken:
+        _changed(booking_date)
+    return taken
+
+
+def ensure_slots(booking_date):
+    """
+    Create the ledger rows of a date, sized with USSD_SLOT_CAPACITY
+    """
+    SlotCapacity.objects.bulk_create(
+        [
+            SlotCapacity(booking_date=booking_date, time_slot=time_slot, capacity=settings.USSD_SLOT_CAPACITY)
+            for time_slot, _ in TIME_SLOTS
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def reserve_seats(booking_date, time_slot, party_size):
+    """
+    Take seats from a slot if enough are left
+
+    Returns:
+        bool: whether the seats were reserved
+    """
+    if _take_seats(booking_date, time_slot, party_size):
+        return True
+
+    # the ledger rows may not exist yet, or expired holds may be in the way
+    ensure_slots(booking_date)
+    release_expired_holds(booking_date=booking_date, time_slot=time_slot)
+    return bool(_take_seats(booking_date, time_slot, party_size))
+
+
+def _freed(party_size):
+    """
+    Reserved seats less `party_size`, floored at zero for bookings the
+    ledger never counted (e.g. made before it existed)
+    """
+    return Greatest(F('reserved') - party_size, 0)
+
+
+def release_seats(slot_id, booking_date, party_size):
+    SlotCapacity.objects.filter(pk=slot_id).update(reserved=_freed(party_size))
+    _changed(booking_date)
+
+
+def hold_seats(session_id, booking_date, time_slot, party_size):
+    """
+    Hold seats for a session until it confirms or the hold expires
+
+    A session holds at most one set of seats; holding again replaces it.
+
+    Returns:
+        bool: whether the seats are held
+    """
+    with transaction.atomic():
+        release_hold(session_id)
+
+        if not reserve_seats(booking_date, time_slot, party_size):
+            return False
+
+        slot_id = SlotCapacity.objects.filter(
+            booking_date=booking_date, time_slot=time_slot
+        ).values_list('pk', flat=True).get()
+        SlotHold.objects.create(
+            slot_id=slot_id,
+            session_id=session_id,
+            party_size=party_size,
+            expires_at=timezone.now() + timedelta(seconds=settings.USSD_SLOT_HOLD_SECONDS),
+        )
+    return True
+
+
+def _locked_hold(session_id):
+    return SlotHold.objects.select_related('slot').select_for_update(of=('self',)).filter(
+        session_id=session_id
+    ).first()
+
+
+def release_hold(session_id):
+    """
+    Give a session's held seats back to its slot
+    """
+    with transaction.atomic():
+        hold = _locked_hold(session_id)
+        if hold is not None:
+            release_seats(hold.slot_id, hold.slot.booking_date, hold.party_size)
+            hold.delete()
+
+
+def _covers(hold, booking):
+    """
+    Whether a hold is for the slot and party size of a booking
+    """
+    return (
+        str(hold.slot.booking_date) == str(booking['booking_date'])
+        and hold.slot.time_slot == booking['time_slot']
+        and hold.party_size == booking['party_size']
+    )
+
+
+def confirm_booking(session_id, **booking):
+    """
+    Turn a session's hold into a booking
+
+    A hold for other seats than booked (the date, slot or party size
+    changed since) is given back and the seats are taken afresh, as they
+    are when the hold already expired.
+
+    Returns:
+        UssdBooking, or None when the slot filled up in the meantime
+    """
+    with transaction.atomic():
+        hold = _locked_hold(session_id)
+
+        if hold is not None and _covers(hold, booking):
+            # the held seats now belong to the booking
+            hold.delete()
+        else:
+            if hold is not None:
+                release_seats(hold.slot_id, hold.slot.booking_date, hold.party_size)
+                hold.delete()
+            if not reserve_seats(booking['booking_date'], booking['time_slot'], booking['party_size']):
+                return None
+
+        return UssdBooking.objects.create(**booking)
+
+
+def release_expired_holds(now=None, booking_date=None, time_slot=None, batch_size=1000):
+    """
+    Return the seats of abandoned sessions to their slots
+
+    Returns:
+        int: number of holds released
+    """
+    now = now or timezone.now()
+    holds = SlotHold.objects.filter(expires_at__lte=now)
+    if booking_date is not None:
+        holds = holds.filter(slot__booking_date=booking_date)
+    if time_slot is not None:
+        holds = holds.filter(slot__time_slot=time_slot)
+
+    released = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                holds.select_for_update(skip_locked=True).values_list('pk', flat=True)[:batch_size]
+            )
+            if not batch:
+                return released
+
+            per_slot = SlotHold.objects.filter(pk__in=batch).values(
+                'slot_id', 'slot__booking_date'
+            ).annotate(seats=Sum('party_size'))
+            for row in per_slot:
+                release_seats(row['slot_id'], row['slot__booking_date'], row['seats'])
+            SlotHold.objects.filter(pk__in=batch).delete()
+            released += len(batch)
+
+
+def cancel_booking(booking):
+    """
+    Cancel a booking and give its seats back to the slot
+
+    Returns:
+        bool: False if the booking was already cancelled
+    """
+    with transaction.atomic():
+        cancelled = UssdBooking.objects.filter(pk=booking.pk).exclude(status=CANCELLED).update(
+            status=CANCELLED, updated_at=timezone.now()
+        )
+        if cancelled:
+            release_booked(booking.booking_date, booking.time_slot, booking.party_size)
+    booking.status = CANCELLED
+    return bool(cancelled)
+
+
+def release_booked(booking_date, time_slot, party_size):
+    SlotCapacity.objects.filter(booking_date=booking_date, time_slot=time_slot).update(
+        reserved=_freed(party_size)
+    )
+    _changed(booking_date)
+
+
+def rebuild(since=None):
+    """
+    Recount the ledger from bookings and live holds, in bulk
+
+    Rows are recounted for every date from `since` on (today by default);
+    capacities are kept, but raised to what is already booked so the
+    ledger stays consistent with bookings taken before it existed. The
+    availability index of every recounted date is rewritten.
+
+    Returns:
+        int: number of dates rebuilt
+    """
+    since = since or timezone.now().date()
+    now = timezone.now()
+
+    with transaction.atomic():
+        ledger = {
+            (slot.booking_date, slot.time_slot): slot
+            for slot in SlotCapacity.objects.select_for_update().filter(booking_date__gte=since)
+        }
+        reserved = dict.fromkeys(ledger, 0)
+
+        booked = UssdBooking.objects.filter(booking_date__gte=since).exclude(status=CANCELLED).values(
+            'booking_date', 'time_slot'
+        ).annotate(seats=Sum('party_size')).order_by()
+        held = SlotHold.objects.filter(slot__booking_date__gte=since, expires_at__gt=now).values(
+            'slot__booking_date', 'slot__time_slot'
+        ).annotate(seats=Sum('party_size')).order_by()
+
+        for row in booked:
+            key = (row['booking_date'], row['time_slot'])
+            reserved[key] = reserved.get(key, 0) + row['seats']
+        for row in held:
+            key = (row['slot__booking_date'], row['slot__time_slot'])
+            reserved[key] = reserved.get(key, 0) + row['seats']
+
+        slots = []
+        for booking_date in {booking_date for booking_date, _ in reserved}:
+            for time_slot, _ in TIME_SLOTS:
+                key = (booking_date, time_slot)
+                seats = reserved.get(key, 0)
+                capacity = ledger[key].capacity if key in ledger else settings.USSD_SLOT_CAPACITY
+                slots.append(SlotCapacity(
+                    booking_date=booking_date,
+                    time_slot=time_slot,
+                    capacity=max(capacity, seats),
+                    reserved=seats,
+                ))
+
+        SlotCapacity.objects.bulk_create(
+            slots,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['booking_date', 'time_slot'],
+            update_fields=['capacity', 'reserved'],
+        )
+        SlotHold.objects.filter(slot__booking_date__gte=since, expires_at__lte=now).delete()
+
+    seats_by_date = {}
+    for slot in slots:
+        seats_by_date.setdefault(slot.booking_date, {})[slot.time_slot] = slot.capacity - slot.reserved
+    availability_index.set_many(seats_by_date)
+    return len(seats_by_date)
@@ -16,4 +16,44 @@ TIME_SLOTS = [
     ('11:00', '11:00 AM - 01:00 PM'),
     ('17:00', '05:00 PM - 07:00 PM'),
     ('20:00', '08:00 PM - 10:00 PM'),
-]
\ No newline at end of file
+]
+
+# Slots as listed on the time slot screen, short enough that the seats
+# left in each fit the screen budget whatever the slot capacity
+TIME_SLOT_LABELS = {
+    '08:00': '08:00-10:00',
+    '11:00': '11:00-13:00',
+    '17:00': '17:00-19:00',
+    '20:00': '20:00-22:00',
+}
+
+# Upcoming bookings listed by "My Bookings"
+MAX_LISTED_BOOKINGS = 5
+
+# SMS outbox delivery states
+SMS_QUEUED = 'queued'
+SMS_SENDING = 'sending'
+SMS_SENT = 'sent'
+SMS_FAILED = 'failed'
+
+SMS_STATUS_CHOICES = [
+    (SMS_QUEUED, 'Queued'),
+    (SMS_SENDING, 'Sending'),
+    (SMS_SENT, 'Sent'),
+    (SMS_FAILED, 'Failed'),
+]
+
+# What the input of a hop was, as logged in UssdHopEvent
+HOP_DIAL = 'dial'
+HOP_OPTION = 'option'
+HOP_INPUT = 'input'
+HOP_MORE = 'more'
+HOP_INVALID = 'invalid'
+
+HOP_INPUT_CHOICES = [
+    (HOP_DIAL, 'Dial'),
+    (HOP_OPTION, 'Option'),
+    (HOP_INPUT, 'Data entry'),
+    (HOP_MORE, 'Next page'),
+    (HOP_INVALID, 'Invalid'),
+]
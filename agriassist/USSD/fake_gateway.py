@@ -0,0 +1,84 @@
+""" local stand-in for the Africa's Talking SMS API"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    # keep-alive, as the real gateway allows
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; without this a kept-alive
+    # connection waits on delayed ACKs between calls
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = parse_qs(self.rfile.read(length).decode())
+        recipients = data.get('to', [''])[0].split(',')
+        self.server.count('calls')
+        self.server.count('messages', len(recipients))
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        body = json.dumps({
+            'SMSMessageData': {
+                'Message': f"Sent to {len(recipients)}/{len(recipients)}",
+                'Recipients': [
+                    {'number': number, 'status': 'Success', 'statusCode': 101,
+                     'cost': 'KES 0.8000', 'messageId': f"ATXid_{index}"}
+                    for index, number in enumerate(recipients)
+                ],
+            }
+        }).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGateway(ThreadingHTTPServer):
+    """
+    Accepts every message after `latency` seconds and counts the
+    connections, calls and messages it received
+
+    Used as a context manager, it serves from a background thread on a
+    free local port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, port=0):
+        super().__init__(('127.0.0.1', port), GatewayHandler)
+        self.latency = latency
+        self.stats = {'connections': 0, 'calls': 0, 'messages': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/version1/messaging"
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
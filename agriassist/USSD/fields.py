@@ -0,0 +1,39 @@
+""" model fields storing ussd session state compactly"""
+
+from django.db import models
+
+from .state_codec import decode, encode, menu_id, menu_name
+
+
+class MenuField(models.PositiveSmallIntegerField):
+    """
+    Name of a flow state, stored as its small integer id (see state_codec.menu_id)
+    """
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else menu_name(value)
+
+    def to_python(self, value):
+        return menu_name(value) if isinstance(value, int) else value
+
+    def get_prep_value(self, value):
+        return None if value is None else menu_id(value)
+
+
+class StateDataField(models.TextField):
+    """
+    temp_data mapping, stored as a compact versioned JSON array (see
+    state_codec.pack)
+    """
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else decode(value)
+
+    def to_python(self, value):
+        return decode(value) if isinstance(value, str) else value
+
+    def get_prep_value(self, value):
+        return None if value is None else encode(value)
+
+    def value_to_string(self, obj):
+        return encode(self.value_from_object(obj))
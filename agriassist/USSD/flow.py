@@ -0,0 +1,321 @@
+""" declarative ussd flows compiled to a dispatch table"""
+
+import inspect
+from functools import lru_cache
+from string import Formatter
+
+from .screens import MORE_OPTION
+from .state_codec import register_menu
+
+
+class FlowError(Exception):
+    """
+    Raised when a flow definition is inconsistent
+    """
+
+
+class UnknownStateError(FlowError, KeyError):
+    """
+    Raised when a session points at a state the flow does not define
+    """
+
+
+INVALID_OPTION = "Invalid option. Please try again."
+
+# temp_data key of the page shown by a paged state; absent on the first
+PAGE_KEY = 'page'
+
+
+class Node:
+    """
+    A state in a USSD flow
+
+    Args:
+        name: state name stored in UssdSessionState.current_menu
+        prompt: screen template, formatted with `user` and `data` (temp_data)
+        screen: name of a handler coroutine rendering the screen instead
+        end: whether showing this state ends the session
+        registered: whether only registered users may reach this state
+        paged: whether the screen is split in pages, turned with "98"
+    """
+
+    def __init__(self, name, prompt='', screen=None, end=False, registered=True, paged=False):
+        self.name = name
+        self.prompt = prompt
+        self.screen = screen
+        self.end = end
+        self.registered = registered
+        self.paged = paged
+        self._screen = None
+        self._text = None
+
+    def targets(self):
+        """
+        Names of the states this node can move to
+        """
+        return set()
+
+    def methods(self):
+        """
+        Names of the handler methods this node calls
+        """
+        return {self.screen} if self.screen else set()
+
+    def bind(self, handler_class):
+        """
+        Resolve handler method names once, at compile time, and render
+        prompts without placeholders
+        """
+        if self.screen:
+            self._screen = getattr(handler_class, self.screen)
+        elif not any(field is not None for _, field, _, _ in Formatter().parse(self.prompt)):
+            self._text = self.prompt.format()
+
+    async def render(self, handler):
+        if self._screen is not None:
+            text = await self._screen(handler)
+        elif self._text is not None:
+            text = self._text
+        else:
+            text = self.prompt.format(user=handler.user, data=handler.state.temp_data)
+        return (text, self.end)
+
+    def navigate(self, user_input):
+        """
+        Next state for an input when it depends on nothing but the input
+
+        Returns None for states that read or write session data, which
+        stops a replay of the navigation path.
+        """
+        return None
+
+    async def handle(self, handler, user_input):
+        """
+        Consume input shown this state's screen
+
+        Returns:
+            str: name of the next state, or
+            tuple: (response_text, is_end) to answer without moving
+        """
+        return (INVALID_OPTION, False)
+
+
+class Menu(Node):
+    """
+    Pure navigation: each option leads to another state
+    """
+
+    def __init__(self, name, options, default=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.options = options
+        self.default = default
+
+    def targets(self):
+        return set(self.options.values()) | ({self.default} if self.default else set())
+
+    def navigate(self, user_input):
+        if self.paged and user_input == MORE_OPTION:
+            # the page cursor lives in temp_data
+            return None
+        # an invalid option leaves the caller on the same menu
+        return self.options.get(user_input, self.default) or self.name
+
+    async def handle(self, handler, user_input):
+        target = self.options.get(user_input, self.default)
+        return target if target is not None else (INVALID_OPTION, False)
+
+
+class Input(Node):
+    """
+    Data entry: the cleaned input is stored in temp_data[key]
+
+    The validator returns the cleaned value or raises ValueError with the
+    message to show. It is either a plain function or the name of a handler
+    coroutine, for checks that need the session or the database.
+    """
+
+    def __init__(self, name, key, next, validator=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.key = key
+        self.next = next
+        self.validator = validator
+        self._validator = None
+
+    def targets(self):
+        return {self.next}
+
+    def methods(self):
+        return super().methods() | ({self.validator} if isinstance(self.validator, str) else set())
+
+    def bind(self, handler_class):
+        super().bind(handler_class)
+        if isinstance(self.validator, str):
+            self._validator = getattr(handler_class, self.validator)
+
+    async def handle(self, handler, user_input):
+        value = user_input.strip()
+        try:
+            if self._validator is not None:
+                value = await self._validator(handler, value)
+            elif self.validator is not None:
+                value = self.validator(value)
+        except ValueError as exc:
+            return (str(exc), False)
+        handler.state.temp_data[self.key] = value
+        return self.next
+
+
+class Choice(Node):
+    """
+    Numbered pick from a list produced by a handler coroutine
+
+    The chosen value is stored in temp_data[key]; `back` is reached with 0.
+    """
+
+    def __init__(self, name, choices, key, next, back, **kwargs):
+        super().__init__(name, **kwargs)
+        self.choices = choices
+        self.key = key
+        self.next = next
+        self.back = back
+        self._choices = None
+
+    def targets(self):
+        return {self.next, self.back}
+
+    def methods(self):
+        return super().methods() | {self.choices}
+
+    def bind(self, handler_class):
+        super().bind(handler_class)
+        self._choices = getattr(handler_class, self.choices)
+
+    async def handle(self, handler, user_input):
+        if user_input == '0':
+            handler.state.temp_data.pop(self.key, None)
+            return self.back
+
+        choices = await self._choices(handler)
+        if user_input.isdigit() and 1 <= int(user_input) <= len(choices):
+            handler.state.temp_data[self.key] = choices[int(user_input) - 1]
+            return self.next
+        return (INVALID_OPTION, False)
+
+
+class Action(Node):
+    """
+    Options that run a handler coroutine, which returns a state name or a
+    (response_text, is_end) tuple
+    """
+
+    def __init__(self, name, actions, default=None, transitions=(), **kwargs):
+        super().__init__(name, **kwargs)
+        self.actions = actions
+        self.default = default
+        self.transitions = set(transitions)
+        self._actions = {}
+        self._default = None
+
+    def targets(self):
+        return set(self.transitions)
+
+    def methods(self):
+        return super().methods() | set(self.actions.values()) | ({self.default} if self.default else set())
+
+    def bind(self, handler_class):
+        super().bind(handler_class)
+        self._actions = {key: getattr(handler_class, method) for key, method in self.actions.items()}
+        self._default = getattr(handler_class, self.default) if self.default else None
+
+    async def handle(self, handler, user_input):
+        action = self._actions.get(user_input, self._default)
+        if action is None:
+            return (INVALID_OPTION, False)
+        return await action(handler)
+
+
+class Flow:
+    """
+    A set of states compiled once into a dict keyed by state name
+
+    Args:
+        states: Node instances
+        initial: state shown to registered users when they dial in
+        unregistered: state shown to users who have not registered yet
+        handler_class: class whose coroutines the nodes refer to by name
+        replay_cache_size: number of navigation path prefixes memoized
+    """
+
+    def __init__(self, states, initial, unregistered, handler_class, replay_cache_size=4096):
+        self.initial = initial
+        self.unregistered = unregistered
+        self.handler_class = handler_class
+        self.dispatch = {}
+        self._replay = lru_cache(maxsize=replay_cache_size)(self._replay_path)
+
+        for node in states:
+            if node.name in self.dispatch:
+                raise FlowError(f"Duplicate state '{node.name}'")
+            self.dispatch[node.name] = node
+
+        self.validate()
+        for node in self.dispatch.values():
+            node.bind(handler_class)
+
+    def validate(self):
+        """
+        Check that every transition and handler method exists, and that
+        every state can be stored in UssdSessionState.current_menu
+        """
+        for entry in (self.initial, self.unregistered):
+            if entry not in self.dispatch:
+                raise FlowError(f"Entry state '{entry}' is not defined")
+
+        for node in self.dispatch.values():
+            for target in node.targets():
+                if target not in self.dispatch:
+                    raise FlowError(f"State '{node.name}' leads to undefined state '{target}'")
+            for method in node.methods():
+                if not inspect.iscoroutinefunction(getattr(self.handler_class, method, None)):
+                    raise FlowError(
+                        f"State '{node.name}' refers to '{method}', which is not a coroutine "
+                        f"of {self.handler_class.__name__}"
+                    )
+            try:
+                register_menu(node.name)
+            except ValueError as exc:
+                raise FlowError(f"{exc}; rename one of them") from None
+
+    def entry_for(self, user):
+        """
+        State a user starts in, depending on whether they registered
+        """
+        return self.initial if user.first_name else self.unregistered
+
+    def replay(self, entry, path):
+        """
+        Follow a navigation path (the segments of AfricasTalking's `text`)
+
+        Returns:
+            str: the state the path leads to, or None once the path goes
+            through a state that depends on session data
+        """
+        return self._replay(entry, tuple(path))
+
+    def _replay_path(self, entry, path):
+        if not path:
+            return entry
+        # prefixes are memoized, so a hop only walks its last segment
+        state = self._replay(entry, path[:-1])
+        if state is None:
+            return None
+        return self.dispatch[state].navigate(path[-1])
+
+    def __getitem__(self, name):
+        try:
+            return self.dispatch[name]
+        except KeyError:
+            raise UnknownStateError(name) from None
+
+    def __contains__(self, name):
+        return name in self.dispatch
@@ -0,0 +1,146 @@
+""" ussd flow definitions"""
+
+from .flow import Action, Choice, Flow, Input, Menu, Node
+from .utils import USSDMenuHandler
+from .validators import name_validator, validate_booking_date
+
+default_flow = Flow(
+    states=[
+        # registration
+        Input(
+            'registration',
+            prompt=(
+                "Welcome to AgriAssist!\n"
+                "You need to register first.\n\n"
+                "Enter your first name:"
+            ),
+            key='first_name',
+            validator=name_validator('first'),
+            next='registration_last_name',
+            registered=False,
+        ),
+        Input(
+            'registration_last_name',
+            prompt="Enter your last name:",
+            key='last_name',
+            validator=name_validator('last'),
+            next='registration_confirm',
+            registered=False,
+        ),
+        Action(
+            'registration_confirm',
+            prompt=(
+                "Confirm registration:\n"
+                "Name: {data[first_name]} {data[last_name]}\n"
+                "Phone: {user.phone_number}\n\n"
+                "1. Confirm\n"
+                "2. Start Over\n"
+                "0. Cancel"
+            ),
+            actions={'1': 'confirm_registration', '2': 'restart_registration'},
+            default='cancel_registration',
+            transitions=['registration'],
+            registered=False,
+        ),
+
+        # main menu
+        Menu(
+            'main_menu',
+            prompt=(
+                "Welcome {user.first_name}!\n\n"
+                "1. View Menu\n"
+                "2. Book Table\n"
+                "3. My Bookings\n"
+                "4. Contact Us\n"
+                "0. Exit"
+            ),
+            options={
+                '1': 'view_menu',
+                '2': 'book_table_menu',
+                '3': 'my_bookings',
+                '4': 'contact_us',
+                '0': 'exit',
+            },
+        ),
+        Node('exit', prompt="Operation cancelled.\n", end=True),
+        Node(
+            'contact_us',
+            prompt=(
+                "Contact Us:\n"
+                "For enquiries call:\n+88-123-123456"
+            ),
+            end=True,
+        ),
+
+        # food menu
+        Choice(
+            'view_menu',
+            screen='view_menu_screen',
+            choices='menu_categories',
+            key='category_id',
+            next='category_menu',
+            back='main_menu',
+            paged=True,
+        ),
+        Choice(
+            'category_menu',
+            screen='category_menu_screen',
+            choices='category_items',
+            key='item_id',
+            next='item_menu',
+            back='view_menu',
+            paged=True,
+        ),
+        Menu('item_menu', screen='item_menu_screen', options={}, default='category_menu'),
+
+        # bookings
+        Node('my_bookings', screen='my_bookings_screen', end=True),
+        Input(
+            'book_table_menu',
+            prompt=(
+                "Booking Information:\n"
+                "Enter booking date (YYYY-MM-DD):"
+            ),
+            key='booking_date',
+            validator=validate_booking_date,
+            next='booking_time_slot',
+        ),
+        Input(
+            'booking_time_slot',
+            screen='time_slot_screen',
+            key='time_slot',
+            validator='check_time_slot',
+            next='booking_party_size',
+        ),
+        Input(
+            'booking_party_size',
+            prompt="Enter number of people:",
+            key='party_size',
+            validator='hold_party_size',
+            next='booking_special_requests',
+        ),
+        Input(
+            'booking_special_requests',
+            prompt="Write any special requests:",
+            key='special_requests',
+            next='booking_confirm',
+        ),
+        Action(
+            'booking_confirm',
+            prompt=(
+                "Confirm booking:\n"
+                "Name: {user.first_name} {user.last_name}\n"
+                "Booking Date: {data[booking_date]}\n"
+                "1. Confirm\n"
+                "2. Edit\n"
+                "0. Cancel"
+            ),
+            actions={'1': 'confirm_booking', '2': 'restart_booking'},
+            default='cancel_booking',
+            transitions=['book_table_menu'],
+        ),
+    ],
+    initial='main_menu',
+    unregistered='registration',
+    handler_class=USSDMenuHandler,
+)
@@ -0,0 +1,104 @@
+""" buffered log of handled hops"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from .models import UssdHopEvent
+
+logger = logging.getLogger(__name__)
+
+
+class HopLog:
+    """
+    In-process buffer of UssdHopEvent rows, written with bulk_create
+
+    The hop that brings the buffer to USSD_HOP_EVENT_BATCH events, or
+    finds its oldest event USSD_HOP_EVENT_FLUSH_MS old, writes them all;
+    every other hop only appends to a list. A timer on the event loop
+    writes what a worker that goes quiet still holds, so every event is
+    written within USSD_HOP_EVENT_FLUSH_MS of its hop, unless the worker
+    exits first. A failed write is logged and dropped: the log feeds
+    statistics and must never fail a hop.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.oldest = None
+        self._lock = threading.Lock()
+        # the loop a timed flush is scheduled on, if any
+        self._timer_loop = None
+        self._flushing = None
+
+    def _append(self, event):
+        """
+        Returns:
+            list: the events to write now, or None
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.events.append(event)
+            if self.oldest is None:
+                self.oldest = now
+            if (
+                len(self.events) < settings.USSD_HOP_EVENT_BATCH
+                and (now - self.oldest) * 1000 < settings.USSD_HOP_EVENT_FLUSH_MS
+            ):
+                return None
+            events, self.events, self.oldest = self.events, [], None
+            return events
+
+    async def arecord(self, session_id, menu, input_class, entered, end, latency):
+        if not settings.USSD_HOP_EVENTS:
+            return
+        events = self._append(UssdHopEvent(
+            session_id=session_id,
+            menu=menu,
+            input_class=input_class,
+            entered=entered,
+            end=end,
+            latency_ms=round(latency * 1000, 2),
+        ))
+        if events:
+            await self._awrite(events)
+        else:
+            loop = asyncio.get_running_loop()
+            if self._timer_loop is not loop:
+                self._timer_loop = loop
+                loop.call_later(settings.USSD_HOP_EVENT_FLUSH_MS / 1000, self._flush_due, loop)
+
+    def _flush_due(self, loop):
+        self._timer_loop = None
+        # referenced until done, or the task could be collected
+        self._flushing = loop.create_task(self.aflush())
+
+    async def aflush(self):
+        """
+        Write every buffered event
+        """
+        with self._lock:
+            events, self.events, self.oldest = self.events, [], None
+        if events:
+            await self._awrite(events)
+
+    async def _awrite(self, events):
+        try:
+            await UssdHopEvent.objects.abulk_create(events)
+        except DatabaseError:
+            logger.exception("Dropped %d hop events", len(events))
+
+    def discard(self, session_prefix):
+        """
+        Drop buffered events of sessions whose id starts with the prefix
+        """
+        with self._lock:
+            self.events = [event for event in self.events if not event.session_id.startswith(session_prefix)]
+            if not self.events:
+                self.oldest = None
+
+
+hop_log = HopLog()
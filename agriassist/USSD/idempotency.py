@@ -0,0 +1,70 @@
+""" replayed responses for carrier retries of a hop"""
+
+import asyncio
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Stored while the first request of a hop is being handled
+PENDING = '__pending__'
+
+
+class ResponseCache:
+    """
+    Rendered responses keyed by (sessionId, text)
+
+    AfricasTalking retries a callback it got no timely answer for, with
+    the same sessionId and text. The first request claims the key with an
+    atomic add; retries get its response back instead of applying the
+    input again, or wait for it while it is still being computed.
+    """
+
+    key_prefix = 'ussd:response:'
+
+    def __init__(self, alias='ussd'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, session_id, text):
+        # `text` grows with every hop, so it is hashed to keep keys short
+        digest = hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+        return f"{self.key_prefix}{session_id}:{digest}"
+
+    async def aclaim(self, session_id, text):
+        """
+        Claim a hop for this request
+
+        Returns:
+            tuple: (claimed, response); response is the body a previous
+            request rendered for the hop, if it finished in time
+        """
+        key = self.key(session_id, text)
+        deadline = asyncio.get_running_loop().time() + settings.USSD_RESPONSE_WAIT
+
+        while True:
+            if await self.cache.aadd(key, PENDING, settings.USSD_RESPONSE_PENDING_TIMEOUT):
+                return True, None
+
+            response = await self.cache.aget(key)
+            # None: the claim was released or expired in between
+            if response is not None and response != PENDING:
+                return False, response
+            if asyncio.get_running_loop().time() >= deadline:
+                return False, None
+            await asyncio.sleep(0.05)
+
+    async def aset(self, session_id, text, response):
+        await self.cache.aset(self.key(session_id, text), response, settings.USSD_RESPONSE_CACHE_TIMEOUT)
+
+    async def arelease(self, session_id, text):
+        """
+        Drop an unanswered claim, so a retry handles the hop afresh
+        """
+        await self.cache.adelete(self.key(session_id, text))
+
+
+response_cache = ResponseCache()
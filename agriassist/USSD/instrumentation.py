@@ -0,0 +1,179 @@
+""" per-hop latency, query and response size metrics"""
+
+import contextvars
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger('agriassist.ussd.hops')
+
+# The hop being measured; unset for unsampled requests, which then cost a
+# single ContextVar lookup per query or SMS
+current_hop = contextvars.ContextVar('ussd_current_hop', default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+SIZE_BUCKETS = (40, 80, 120, 160, 182, 250, 500)
+
+
+class Hop:
+    """
+    Measurements of one sampled hop
+    """
+    __slots__ = ('menu', 'end', 'started', 'db_queries', 'db_time', 'sms_time', 'response_bytes')
+
+    def __init__(self):
+        self.menu = None
+        self.end = False
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.sms_time = 0.0
+        self.response_bytes = 0
+
+
+class Histogram:
+    """
+    Cumulative histogram per menu, in the Prometheus exposition format
+    """
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, menu, value):
+        with self._lock:
+            series = self._series.get(menu)
+            if series is None:
+                # one count per bucket plus +Inf, then the sum
+                series = self._series[menu] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {menu: list(values) for menu, values in self._series.items()}
+
+        for menu, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{menu="{menu}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{menu="{menu}"}} {values[-1]}')
+            lines.append(f'{self.name}_count{{menu="{menu}"}} {cumulative}')
+        return '\n'.join(lines)
+
+
+class Registry:
+    """
+    Histograms of this worker process
+
+    Each worker keeps its own; scrape every worker, or turn on
+    USSD_METRICS_LOG and aggregate the log lines instead.
+    """
+
+    def __init__(self):
+        self.duration = Histogram(
+            'ussd_hop_duration_seconds', "Wall time of a USSD hop", LATENCY_BUCKETS)
+        self.db_queries = Histogram(
+            'ussd_hop_db_queries', "Database queries run by a USSD hop", QUERY_BUCKETS)
+        self.db_time = Histogram(
+            'ussd_hop_db_seconds', "Time a USSD hop spent in database queries", LATENCY_BUCKETS)
+        self.sms_time = Histogram(
+            'ussd_hop_sms_seconds', "Time a USSD hop spent queueing SMS", LATENCY_BUCKETS)
+        self.response_bytes = Histogram(
+            'ussd_response_bytes', "Size of USSD responses", SIZE_BUCKETS)
+
+    def record(self, hop, duration):
+        menu = hop.menu or 'unknown'
+        self.duration.observe(menu, duration)
+        self.db_queries.observe(menu, hop.db_queries)
+        self.db_time.observe(menu, hop.db_time)
+        self.sms_time.observe(menu, hop.sms_time)
+        self.response_bytes.observe(menu, hop.response_bytes)
+
+    def render(self):
+        return '\n\n'.join(
+            histogram.render()
+            for histogram in (self.duration, self.db_queries, self.db_time, self.sms_time, self.response_bytes)
+        ) + '\n'
+
+
+registry = Registry()
+
+
+def start_hop():
+    hop = Hop()
+    return hop, current_hop.set(hop)
+
+
+def finish_hop(hop, token, log=False):
+    """
+    Stop measuring a hop and add it to the histograms
+    """
+    duration = time.perf_counter() - hop.started
+    current_hop.reset(token)
+    registry.record(hop, duration)
+    if log:
+        logger.info(json.dumps({
+            'menu': hop.menu,
+            'end': hop.end,
+            'duration_ms': round(duration * 1000, 2),
+            'db_queries': hop.db_queries,
+            'db_ms': round(hop.db_time * 1000, 2),
+            'sms_ms': round(hop.sms_time * 1000, 2),
+            'response_bytes': hop.response_bytes,
+        }))
+
+
+def note_menu(name):
+    """
+    Label the current hop with a state it went through; the last one
+    wins, so a hop is labelled with the screen it resolved to, or with
+    the state that answered it directly
+    """
+    hop = current_hop.get()
+    if hop is not None:
+        hop.menu = name
+
+
+def count_queries(execute, sql, params, many, context):
+    """
+    Connection execute wrapper timing the queries of sampled hops
+    """
+    hop = current_hop.get()
+    if hop is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        hop.db_queries += 1
+        hop.db_time += time.perf_counter() - started
+
+
+def instrument_connection(sender, connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+class timed_sms:
+    """
+    Add the time spent queueing an SMS to the current hop
+    """
+
+    def __enter__(self):
+        self.hop = current_hop.get()
+        if self.hop is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.hop is not None:
+            self.hop.sms_time += time.perf_counter() - self.started
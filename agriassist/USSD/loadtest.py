@@ -0,0 +1,334 @@
+""" load generator replaying AfricasTalking USSD traffic"""
+
+import asyncio
+import contextvars
+import random
+import statistics
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from urllib.parse import urlencode, urlsplit
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from . import capacity
+from .hop_log import hop_log
+from .models import SlotHold, SmsOutbox, UssdHopEvent, UssdSessionArchive, UssdUser
+
+SERVICE_CODE = '*384*123#'
+CALLBACK_PATH = '/ussd/callback/'
+
+# Queries of the hop being replayed; the ORM's worker thread inherits it
+# through sync_to_async, so concurrent hops count separately
+_hop_queries = contextvars.ContextVar('hop_queries', default=None)
+
+
+def browse_path():
+    """
+    main_menu -> view_menu -> a category -> an item -> back to the category
+    """
+    return ['1', str(random.randint(1, 3)), str(random.randint(1, 5)), '0']
+
+
+def booking_path():
+    """
+    The whole book_table_menu flow up to confirmation
+    """
+    booking_date = date.today() + timedelta(days=random.randint(1, 60))
+    return [
+        '2',
+        booking_date.isoformat(),
+        str(random.randint(1, 4)),
+        str(random.randint(1, 6)),
+        random.choice(['none', 'window seat', 'birthday']),
+        '1',
+    ]
+
+
+def exit_path():
+    return [random.choice(['0', '4'])]
+
+
+SCENARIOS = {
+    'browse': (browse_path, 6),
+    'booking': (booking_path, 3),
+    'exit': (exit_path, 1),
+}
+
+
+@dataclass
+class Hop:
+    scenario: str
+    latency: float
+    ok: bool
+    queries: int = None
+
+
+@dataclass
+class Report:
+    run_id: int = 0
+    hops: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    def completed(self):
+        """
+        Latencies of the hops answered with a CON or END screen, sorted;
+        failed hops are left out, as a refused connection fails fast
+        """
+        return sorted(hop.latency for hop in self.hops if hop.ok)
+
+    def summary(self, budget):
+        latencies = self.completed()
+        errors = len(self.hops) - len(latencies)
+        queries = [hop.queries for hop in self.hops if hop.queries is not None]
+
+        lines = [
+            f"hops:        {len(self.hops)} in {self.elapsed:.1f}s "
+            f"({len(self.hops) / self.elapsed if self.elapsed else 0:.0f} hops/s)",
+            f"errors:      {errors} ({errors / len(self.hops) if self.hops else 0:.2%})",
+        ]
+        if latencies:
+            quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            lines += [
+                f"latency ms:  p50 {quantiles[49] * 1000:.1f}  p95 {quantiles[94] * 1000:.1f}  "
+                f"p99 {quantiles[98] * 1000:.1f}  max {latencies[-1] * 1000:.1f}",
+                f"over budget: {sum(latency > budget for latency in latencies)} hops slower than {budget:.2f}s",
+            ]
+        else:
+            lines.append("latency ms:  no hop completed")
+        if queries:
+            lines.append(
+                f"queries/hop: mean {statistics.fmean(queries):.2f}  max {max(queries)}"
+            )
+        for scenario in ['registration', *SCENARIOS]:
+            scenario_latencies = [hop.latency for hop in self.hops if hop.scenario == scenario and hop.ok]
+            if len(scenario_latencies) > 1:
+                lines.append(
+                    f"  {scenario:<12} {len(scenario_latencies):>7} hops  "
+                    f"p95 {statistics.quantiles(scenario_latencies, n=100)[94] * 1000:.1f} ms"
+                )
+        return '\n'.join(lines)
+
+
+class AsgiTarget:
+    """
+    Posts straight into the ASGI application, in this process
+
+    Every query is attributed to the hop that ran it.
+    """
+
+    counts_queries = True
+
+    def __init__(self, application, host):
+        self.application = application
+        self.host = host
+        connection_created.connect(self._instrument)
+        for connection in connections.all(initialized_only=True):
+            self._instrument(connection=connection)
+
+    @staticmethod
+    def _count(execute, sql, params, many, context):
+        queries = _hop_queries.get()
+        if queries is not None:
+            queries[0] += 1
+        return execute(sql, params, many, context)
+
+    def _instrument(self, sender=None, connection=None, **kwargs):
+        if self._count not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self._count)
+
+    async def post(self, data):
+        body = urlencode(data).encode()
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'POST',
+            'scheme': 'http',
+            'path': CALLBACK_PATH,
+            'raw_path': CALLBACK_PATH.encode(),
+            'query_string': b'',
+            'headers': [
+                (b'host', self.host.encode()),
+                (b'content-type', b'application/x-www-form-urlencoded'),
+                (b'content-length', str(len(body)).encode()),
+            ],
+            'client': ('127.0.0.1', 0),
+            'server': (self.host, 80),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        status = None
+        chunks = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # the handler waits on this for a disconnect once it responded
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        queries = [0]
+        token = _hop_queries.set(queries)
+        try:
+            await self.application(scope, receive, send)
+        finally:
+            _hop_queries.reset(token)
+        return status, b''.join(chunks).decode(), queries[0]
+
+    def close(self):
+        connection_created.disconnect(self._instrument)
+
+
+class HttpTarget:
+    """
+    Posts to a running server over plain HTTP/1.1 connections
+    """
+
+    counts_queries = False
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError("Only http:// URLs are supported")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or CALLBACK_PATH
+
+    async def post(self, data):
+        body = urlencode(data).encode()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(
+                f"POST {self.path} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"Content-Type: application/x-www-form-urlencoded\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, content = response.partition(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1])
+        return status, content.decode(), None
+
+    def close(self):
+        pass
+
+
+def phone_numbers(run_id, dialers):
+    return [f"+2547{run_id:04d}{number:05d}" for number in range(dialers)]
+
+
+def session_prefix(run_id):
+    return f"load-{run_id:04d}-"
+
+
+async def afree_run_id(dialers):
+    """
+    A run id none of whose dialer numbers belongs to an existing user, so
+    every dialer starts unregistered and cleanup() removes only its own
+    """
+    while True:
+        run_id = random.randint(0, 9999)
+        if not await UssdUser.objects.filter(phone_number__in=phone_numbers(run_id, dialers)).aexists():
+            return run_id
+
+
+def cleanup(run_id, dialers):
+    """
+    Delete what an in-process run wrote: its users with their sessions
+    and bookings, whose seats go back to their slots, its seat holds,
+    queued SMS, archived sessions and hop events
+
+    Returns:
+        int: number of users deleted
+    """
+    prefix = session_prefix(run_id)
+    numbers = phone_numbers(run_id, dialers)
+
+    hop_log.discard(prefix)
+    UssdHopEvent.objects.filter(session_id__startswith=prefix).delete()
+    for session_id in SlotHold.objects.filter(session_id__startswith=prefix).values_list('session_id', flat=True):
+        capacity.release_hold(session_id)
+    SmsOutbox.objects.filter(phone_number__in=numbers).delete()
+
+    users = UssdUser.objects.filter(phone_number__in=numbers)
+    UssdSessionArchive.objects.filter(user_id__in=users.values('pk')).delete()
+    # cascades to sessions and bookings; each booking's post_delete
+    # receiver gives its seats back
+    _, deleted = users.delete()
+    return deleted.get(UssdUser._meta.label, 0)
+
+
+async def run_session(target, report, phone_number, scenario, path, think):
+    """
+    Dial once and walk a path, one POST per hop as AfricasTalking sends them
+    """
+    session_id = session_prefix(report.run_id) + uuid.uuid4().hex
+    for depth in range(len(path) + 1):
+        data = {
+            'sessionId': session_id,
+            'serviceCode': SERVICE_CODE,
+            'phoneNumber': phone_number,
+            'text': '*'.join(path[:depth]),
+        }
+        started = time.perf_counter()
+        try:
+            status, text, queries = await target.post(data)
+            ok = status == 200 and text.startswith(('CON ', 'END '))
+        except Exception:
+            text, queries, ok = '', None, False
+        report.hops.append(Hop(scenario, time.perf_counter() - started, ok, queries))
+
+        if not ok or text.startswith('END '):
+            return
+        if think:
+            await asyncio.sleep(random.uniform(0, 2 * think))
+
+
+async def run_dialer(target, report, phone_number, sessions, think):
+    """
+    A caller: registers on their first dial, then uses the service
+    """
+    first_name = random.choice(['Amina', 'Brian', 'Wanjiru', 'Otieno', 'Zawadi'])
+    await run_session(target, report, phone_number, 'registration', [first_name, 'Test', '1'], think)
+
+    names = list(SCENARIOS)
+    weights = [weight for _, weight in SCENARIOS.values()]
+    for _ in range(sessions):
+        scenario = random.choices(names, weights)[0]
+        await run_session(target, report, phone_number, scenario, SCENARIOS[scenario][0](), think)
+
+
+async def run(target, dialers, sessions, think=0.0, ramp_up=0.0, run_id=None):
+    """
+    Run `dialers` concurrent callers making `sessions` sessions each
+
+    Callers get numbers unique to the run (see phone_numbers()), so pass
+    a run_id from afree_run_id() to have every one start unregistered.
+
+    Returns:
+        Report
+    """
+    report = Report(run_id=random.randint(0, 9999) if run_id is None else run_id)
+    numbers = phone_numbers(report.run_id, dialers)
+    started = time.perf_counter()
+
+    async def dialer(number):
+        if ramp_up:
+            await asyncio.sleep(ramp_up * number / dialers)
+        await run_dialer(target, report, numbers[number], sessions, think)
+
+    await asyncio.gather(*(dialer(number) for number in range(dialers)))
+    report.elapsed = time.perf_counter() - started
+    return report
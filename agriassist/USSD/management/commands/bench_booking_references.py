@@ -0,0 +1,69 @@
+""" benchmark booking reference allocation"""
+
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from agriassist.USSD.models import UssdBooking, UssdUser
+from agriassist.USSD.references import ReferenceAllocator
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Create bookings with allocated references and report collisions (rolled back unless --keep)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1_000_000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--keep', action='store_true',
+                            help="Commit the benchmark bookings instead of rolling them back")
+
+    def handle(self, *args, **options):
+        count = options['count']
+        batch_size = options['batch_size']
+        allocator = ReferenceAllocator()
+        seen = set()
+
+        # blocks are reserved outside the benchmark's transaction, as they
+        # are by the USSD handler
+        started = time.perf_counter()
+        references = [allocator.allocate() for _ in range(count)]
+        allocated = time.perf_counter()
+
+        try:
+            with transaction.atomic():
+                user, _ = UssdUser.objects.get_or_create(
+                    phone_number='+000000000000', defaults={'first_name': 'Benchmark'}
+                )
+
+                for offset in range(0, count, batch_size):
+                    UssdBooking.objects.bulk_create([
+                        UssdBooking(
+                            user=user,
+                            reference_number=reference,
+                            booking_date=date.today(),
+                            time_slot='08:00',
+                            party_size=2,
+                        )
+                        for reference in references[offset:offset + batch_size]
+                    ])
+                    seen.update(references[offset:offset + batch_size])
+
+                if not options['keep']:
+                    raise Rollback
+        except Rollback:
+            pass
+        finished = time.perf_counter()
+
+        self.stdout.write(
+            f"{count} references allocated in {allocated - started:.2f}s "
+            f"with {allocator.reservations} block reservations\n"
+            f"{count} bookings inserted in {finished - allocated:.2f}s "
+            f"({'kept' if options['keep'] else 'rolled back'})\n"
+            f"collisions: {count - len(seen)}"
+        )
@@ -0,0 +1,95 @@
+""" benchmark ussd_callback latency against a growing session history"""
+
+import asyncio
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from agriassist.USSD.hop_log import hop_log
+from agriassist.USSD.models import UssdHopEvent, UssdSession, UssdSessionArchive, UssdUser
+from agriassist.USSD.views import ussd_callback
+
+BENCH_PREFIX = 'bench-'
+BENCH_PHONE = '+000000000001'
+
+
+class Command(BaseCommand):
+    help = (
+        "Grow the UssdSession table in steps and time ussd_callback after each one; "
+        "the generated sessions, their hop events and the benchmark caller are deleted afterwards unless --keep"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000_000,
+                            help="Session rows to reach")
+        parser.add_argument('--steps', type=int, default=5)
+        parser.add_argument('--hops', type=int, default=200,
+                            help="Dials timed after each step")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--keep', action='store_true')
+
+    def handle(self, *args, **options):
+        user, _ = UssdUser.objects.get_or_create(
+            phone_number=BENCH_PHONE, defaults={'first_name': 'Benchmark'}
+        )
+        factory = RequestFactory()
+        step_size = options['rows'] // options['steps']
+
+        self.stdout.write("rows         p50 ms   p95 ms   p99 ms")
+        try:
+            for step in range(options['steps'] + 1):
+                if step:
+                    self.grow(user, step_size, options['batch_size'])
+                latencies = asyncio.run(self.dial(factory, options['hops']))
+                quantiles = statistics.quantiles(latencies, n=100)
+                self.stdout.write(
+                    f"{UssdSession.objects.count():<12} "
+                    f"{quantiles[49]:<8.2f} {quantiles[94]:<8.2f} {quantiles[98]:.2f}"
+                )
+        finally:
+            if not options['keep']:
+                self.cleanup()
+
+    def cleanup(self):
+        UssdSession.objects.filter(session_id__startswith=BENCH_PREFIX).delete()
+        # sessions the reaper archived meanwhile, and the hops logged
+        UssdSessionArchive.objects.filter(session_id__startswith=BENCH_PREFIX).delete()
+        hop_log.discard(BENCH_PREFIX)
+        UssdHopEvent.objects.filter(session_id__startswith=BENCH_PREFIX).delete()
+        UssdUser.objects.filter(phone_number=BENCH_PHONE).delete()
+
+    def grow(self, user, count, batch_size):
+        for offset in range(0, count, batch_size):
+            UssdSession.objects.bulk_create([
+                UssdSession(
+                    session_id=BENCH_PREFIX + uuid.uuid4().hex,
+                    user=user,
+                    service_code='*384*123#',
+                    is_active=False,
+                )
+                for _ in range(min(batch_size, count - offset))
+            ])
+
+    async def dial(self, factory, hops):
+        """
+        Time the first hop of new sessions, which looks up and inserts by
+        session_id, and the hop to the booking menu, which is replayed
+        from `text` without reading the session at all
+        """
+        latencies = []
+        for _ in range(hops):
+            session_id = BENCH_PREFIX + uuid.uuid4().hex
+            for text in ('', '2'):
+                request = factory.post('/ussd/callback/', {
+                    'sessionId': session_id,
+                    'serviceCode': '*384*123#',
+                    'phoneNumber': BENCH_PHONE,
+                    'text': text,
+                })
+                started = time.perf_counter()
+                await ussd_callback(request)
+                latencies.append((time.perf_counter() - started) * 1000)
+        return latencies
@@ -0,0 +1,124 @@
+""" benchmark the encoding of ussd session state"""
+
+import json
+import pickle
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+
+from agriassist.USSD.fields import MenuField, StateDataField
+from agriassist.USSD.models import UssdSession, UssdSessionState, UssdUser
+from agriassist.USSD.session_store import restore, snapshot
+from agriassist.USSD.state_codec import decode, encode
+
+# a session at the last step of a booking
+TEMP_DATA = {
+    'booking_date': '2026-10-20',
+    'time_slot': '17:00',
+    'party_size': 4,
+    'special_requests': 'window seat',
+}
+CURRENT_MENU = 'booking_confirm'
+
+
+def json_snapshot(session, state):
+    """
+    The store snapshot as it was before the compact encoding, and the
+    restore that went with it
+    """
+    return {
+        'session': {
+            'id': session.pk,
+            'session_id': session.session_id,
+            'user_id': session.user_id,
+            'service_code': session.service_code,
+        },
+        'state': {
+            'id': state.pk,
+            'current_menu': state.current_menu,
+            'menu_history': [],
+            'temp_data': dict(state.temp_data),
+        },
+    }
+
+
+def round_trip(field, value):
+    """
+    A value written through a model field and read back, as the ORM
+    converts a column
+    """
+    if isinstance(field, models.JSONField):
+        # serialized by the backend, or by the driver on Postgres
+        column = json.dumps(value, cls=field.encoder)
+    else:
+        column = field.get_prep_value(value)
+    return field.from_db_value(column, None, connection)
+
+
+def json_restore(data, user):
+    session = UssdSession.from_db('default', list(data['session']), list(data['session'].values()))
+    session.user = user
+    state_data = data['state']
+    state = UssdSessionState(
+        id=state_data['id'],
+        session=session,
+        current_menu=state_data['current_menu'],
+        temp_data=dict(state_data['temp_data']),
+    )
+    state._state.adding = state_data['id'] is None
+    return session, state
+
+
+class Command(BaseCommand):
+    help = "Compare the size and encoding cost of session state, JSON objects against the compact encoding"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100_000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        user = UssdUser(pk=1, phone_number='+254700000000', first_name='Bench')
+        session = UssdSession(pk=123456, session_id='ATUid_' + 'f' * 32, user=user, service_code='*384*123#')
+        state = UssdSessionState(pk=None, session=session, current_menu=CURRENT_MENU, temp_data=TEMP_DATA)
+
+        def time_us(function):
+            return timeit.timeit(function, number=iterations) / iterations * 1e6
+
+        # the state row: its JSON columns against the packed text and the
+        # menu's smallint, converted by the model fields as the ORM does
+        json_row = [CURRENT_MENU, json.dumps([]), json.dumps(TEMP_DATA)]
+        json_row_size = sum(len(value.encode()) for value in json_row)
+        compact_row_size = len(encode(TEMP_DATA).encode()) + 2
+        json_field, menu_field, data_field = models.JSONField(), MenuField(), StateDataField()
+        json_row_us = time_us(lambda: (
+            round_trip(json_field, TEMP_DATA), round_trip(json_field, []),
+        ))
+        compact_row_us = time_us(lambda: (
+            round_trip(data_field, TEMP_DATA), round_trip(menu_field, CURRENT_MENU),
+        ))
+        # the encodings alone
+        json_codec_us = time_us(lambda: json.loads(json.dumps(TEMP_DATA)))
+        compact_codec_us = time_us(lambda: decode(encode(TEMP_DATA)))
+
+        # the session store entry written by data-entry hops, pickled as
+        # the Redis cache backend does
+        old = json_snapshot(session, state)
+        new = snapshot(session, state)
+        old_size = len(pickle.dumps(old, pickle.HIGHEST_PROTOCOL))
+        new_size = len(pickle.dumps(new, pickle.HIGHEST_PROTOCOL))
+        old_us = time_us(lambda: json_restore(
+            pickle.loads(pickle.dumps(json_snapshot(session, state), pickle.HIGHEST_PROTOCOL)), user
+        ))
+        new_us = time_us(lambda: restore(
+            pickle.loads(pickle.dumps(snapshot(session, state), pickle.HIGHEST_PROTOCOL)), session.session_id, user
+        ))
+
+        self.stdout.write(
+            f"{'':<28}{'json':>10}{'compact':>10}\n"
+            f"{'state row bytes':<28}{json_row_size:>10}{compact_row_size:>10}\n"
+            f"{'state row fields us':<28}{json_row_us:>10.2f}{compact_row_us:>10.2f}\n"
+            f"{'  of which encoding us':<28}{json_codec_us:>10.2f}{compact_codec_us:>10.2f}\n"
+            f"{'store entry bytes':<28}{old_size:>10}{new_size:>10}\n"
+            f"{'store entry round-trip us':<28}{old_us:>10.2f}{new_us:>10.2f}"
+        )
@@ -0,0 +1,66 @@
+""" benchmark SMS outbox delivery against a local fake gateway"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agriassist.USSD.constants import SMS_QUEUED, SMS_SENDING, SMS_SENT
+from agriassist.USSD.fake_gateway import FakeGateway
+from agriassist.USSD.models import SmsOutbox
+from agriassist.USSD.sms import AfricasTalkingTransport, TokenBucket, deliver_pending
+
+
+class Command(BaseCommand):
+    help = "Drain a generated outbox through a local fake gateway and report messages/second"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--bodies', type=int, default=50,
+                            help="Distinct message bodies, e.g. one reminder per time slot and date")
+        parser.add_argument('--latency', type=float, default=0.02,
+                            help="Seconds the fake gateway takes to answer a call")
+        parser.add_argument('--rate', type=float, default=0,
+                            help="Gateway calls per second (0: unlimited)")
+        parser.add_argument('--burst', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--no-pool', action='store_true',
+                            help="Open a connection per gateway call, as the Africa's Talking SDK does")
+
+    def handle(self, *args, **options):
+        # the bench drains the whole outbox, so it must hold nothing real
+        if SmsOutbox.objects.filter(status__in=[SMS_QUEUED, SMS_SENDING]).exists():
+            raise CommandError("The outbox has undelivered messages; run the benchmark against an empty outbox")
+
+        count = options['messages']
+        bucket = TokenBucket(options['rate'], options['burst'])
+
+        with FakeGateway(latency=options['latency']) as gateway:
+            transport = AfricasTalkingTransport(
+                url=gateway.url, username='benchmark', api_key='benchmark', pooled=not options['no_pool']
+            )
+            # no surrounding transaction, so the claim and result commits
+            # of deliver_pending are measured as the worker runs them
+            created = SmsOutbox.objects.bulk_create([
+                SmsOutbox(
+                    phone_number=f"+2547{index:08d}",
+                    message=f"Reminder: your booking on slot {index % options['bodies']} is tomorrow.",
+                )
+                for index in range(count)
+            ], batch_size=1000)
+            try:
+                started = time.perf_counter()
+                delivered = 0
+                while processed := deliver_pending(transport, options['batch_size'], bucket):
+                    delivered += processed
+                elapsed = time.perf_counter() - started
+                sent = SmsOutbox.objects.filter(status=SMS_SENT, pk__in=[sms.pk for sms in created]).count()
+            finally:
+                for offset in range(0, count, 1000):
+                    SmsOutbox.objects.filter(pk__in=[sms.pk for sms in created[offset:offset + 1000]]).delete()
+
+        stats = gateway.stats
+        self.stdout.write(
+            f"{delivered} messages ({sent} accepted) in {elapsed:.2f}s: {delivered / elapsed:.0f} messages/s\n"
+            f"gateway calls: {stats['calls']} ({delivered / max(stats['calls'], 1):.1f} recipients/call), "
+            f"connections opened: {stats['connections']}"
+        )
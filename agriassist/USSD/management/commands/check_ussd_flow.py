@@ -0,0 +1,57 @@
+""" validate and benchmark the compiled ussd flow"""
+
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agriassist.USSD.flow import Menu
+from agriassist.USSD.router import get_flow_router
+from agriassist.USSD.models import UssdSession, UssdSessionState, UssdUser
+from agriassist.USSD.utils import USSDMenuHandler
+
+
+class Command(BaseCommand):
+    help = "Validate every routed USSD flow graph and time dispatch of its static states, without a database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        flows = get_flow_router().flows()
+        if not flows:
+            raise CommandError("No flow is configured in USSD_FLOWS or USSD_DEFAULT_FLOW")
+        for flow in flows:
+            self.check_flow(flow, options['iterations'])
+
+    def check_flow(self, flow, iterations):
+        flow.validate()
+        self.stdout.write(f"{len(flow.dispatch)} states, entry '{flow.initial}' / '{flow.unregistered}': OK")
+
+        # states whose screen is a plain template render without queries
+        static = [name for name, node in flow.dispatch.items() if node.screen is None]
+        menus = [(name, key) for name, node in flow.dispatch.items()
+                 if isinstance(node, Menu) for key in node.options]
+
+        user = UssdUser(phone_number='+254700000000', first_name='Bench', last_name='Mark')
+        session = UssdSession(session_id='bench', user=user, service_code='*384#')
+        state = UssdSessionState(session=session, temp_data={
+            'first_name': 'Bench', 'last_name': 'Mark', 'booking_date': '2030-01-01',
+        })
+        handler = USSDMenuHandler(user, session, state, '1', flow)
+
+        async def run():
+            for i in range(iterations):
+                name = static[i % len(static)]
+                await flow[name].render(handler)
+                menu, key = menus[i % len(menus)]
+                await flow[menu].handle(handler, key)
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{iterations} lookup+render+transition rounds in {elapsed:.3f}s "
+            f"({elapsed / iterations * 1e6:.2f} us/round)"
+        )
@@ -0,0 +1,90 @@
+""" load test the ussd callback with simulated dialers"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from agriassist.USSD.loadtest import AsgiTarget, HttpTarget, afree_run_id, cleanup, run
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate concurrent dialers registering, browsing the menu and booking tables, "
+        "against the ASGI app in-process (default) or a running server (--url). "
+        "In-process runs write to the configured database and delete what they wrote when done"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dialers', type=int, default=1000,
+                            help="Concurrent callers")
+        parser.add_argument('--sessions', type=int, default=3,
+                            help="Sessions per caller after registering")
+        parser.add_argument('--think', type=float, default=0.0,
+                            help="Mean seconds a caller waits between hops")
+        parser.add_argument('--ramp-up', type=float, default=0.0,
+                            help="Seconds over which callers start dialing")
+        parser.add_argument('--url', default=None,
+                            help="Callback URL of a running server, e.g. http://127.0.0.1:8000/ussd/callback/")
+        parser.add_argument('--host', default=None,
+                            help="Host header for in-process requests (first ALLOWED_HOSTS entry by default)")
+        parser.add_argument('--budget', type=float, default=1.0,
+                            help="Seconds a hop may take before the carrier gives up on it")
+        parser.add_argument('--max-p99', type=float, default=None,
+                            help="Fail if the p99 latency exceeds this many seconds")
+        parser.add_argument('--max-error-rate', type=float, default=None,
+                            help="Fail if more than this fraction of hops fail")
+        parser.add_argument('--force', action='store_true',
+                            help="Run in-process even though DEBUG is off")
+
+    def handle(self, *args, **options):
+        dialers = options['dialers']
+
+        if options['url']:
+            target = HttpTarget(options['url'])
+        else:
+            # callers register and book real seats in this database
+            if not settings.DEBUG and not options['force']:
+                raise CommandError(
+                    "In-process load tests write to the configured database; "
+                    "run with DEBUG on, or pass --force"
+                )
+            from agriassist.config.asgi import application
+
+            host = options['host'] or next(
+                (host.lstrip('.') for host in settings.ALLOWED_HOSTS if host and host != '*'), 'localhost'
+            )
+            target = AsgiTarget(application, host)
+
+        async def load():
+            run_id = None if options['url'] else await afree_run_id(dialers)
+            try:
+                return await run(
+                    target, dialers, options['sessions'],
+                    think=options['think'], ramp_up=options['ramp_up'], run_id=run_id,
+                )
+            finally:
+                if run_id is not None:
+                    deleted = await sync_to_async(cleanup)(run_id, dialers)
+                    self.stdout.write(f"Deleted the {deleted} users of run {run_id:04d} and their data")
+
+        try:
+            report = asyncio.run(load())
+        finally:
+            target.close()
+
+        self.stdout.write(report.summary(options['budget']))
+
+        if not report.hops:
+            raise CommandError("No hop was run")
+        latencies = report.completed()
+        error_rate = sum(not hop.ok for hop in report.hops) / len(report.hops)
+        if options['max_p99'] is not None:
+            if not latencies:
+                raise CommandError("No hop completed, so there is no p99 latency to check")
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            if p99 > options['max_p99']:
+                raise CommandError(f"p99 latency {p99:.3f}s is over {options['max_p99']}s")
+        if options['max_error_rate'] is not None and error_rate > options['max_error_rate']:
+            raise CommandError(f"error rate {error_rate:.2%} is over {options['max_error_rate']:.2%}")
@@ -0,0 +1,29 @@
+""" deliver queued SMS from the outbox"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from agriassist.USSD.sms import deliver_pending
+
+
+class Command(BaseCommand):
+    help = "Drain the SMS outbox, batching recipients of identical messages and retrying failures"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help="Seconds to sleep when the outbox is empty")
+        parser.add_argument('--once', action='store_true',
+                            help="Process a single batch and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            processed = deliver_pending(batch_size=options['batch_size'])
+            if processed:
+                self.stdout.write(f"Processed {processed} messages")
+
+            if options['once']:
+                return
+            if processed < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+""" close dropped ussd sessions and archive finished ones"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from agriassist.USSD.capacity import release_expired_holds
+from agriassist.USSD.reaper import reap
+
+
+class Command(BaseCommand):
+    help = "Close sessions the carrier dropped, archive old finished sessions and release expired seat holds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--interval', type=float, default=60.0,
+                            help="Seconds to sleep between rounds")
+        parser.add_argument('--once', action='store_true',
+                            help="Run a single round and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            closed, archived = reap(batch_size=options['batch_size'])
+            released = release_expired_holds()
+            if closed or archived or released:
+                self.stdout.write(
+                    f"Closed {closed} sessions, archived {archived}, released {released} seat holds"
+                )
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
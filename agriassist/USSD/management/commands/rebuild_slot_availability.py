@@ -0,0 +1,19 @@
+""" rebuild the slot capacity ledger and availability index from bookings"""
+
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from agriassist.USSD import capacity
+
+
+class Command(BaseCommand):
+    help = "Recount reserved seats per (date, time slot) from bookings and live holds, and refresh the availability index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat, default=None,
+                            help="First booking date to rebuild (YYYY-MM-DD), today by default")
+
+    def handle(self, *args, **options):
+        dates = capacity.rebuild(since=options['since'])
+        self.stdout.write(f"Rebuilt availability of {dates} dates")
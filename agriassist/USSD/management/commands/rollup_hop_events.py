@@ -0,0 +1,29 @@
+""" fold the hop log into daily funnel rollups"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from agriassist.USSD.rollups import prune_hop_events, rollup_hop_events
+
+
+class Command(BaseCommand):
+    help = "Add settled hop events to the daily per-state funnel counters and prune old events"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument('--interval', type=float, default=300.0,
+                            help="Seconds to sleep between rounds")
+        parser.add_argument('--once', action='store_true',
+                            help="Run a single round and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            rolled_up = rollup_hop_events(batch_size=options['batch_size'])
+            pruned = prune_hop_events()
+            if rolled_up or pruned:
+                self.stdout.write(f"Rolled up {rolled_up} hop events, pruned {pruned}")
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+""" queue reminders for tomorrow's bookings"""
+
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from agriassist.USSD.reminders import send_reminders
+
+
+class Command(BaseCommand):
+    help = "Queue an SMS reminder for every booking of tomorrow (or --date) that has not had one"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat,
+                            help="Booking date to remind, YYYY-MM-DD (default: tomorrow)")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        queued = send_reminders(options['date'], chunk_size=options['chunk_size'])
+        self.stdout.write(f"Queued {queued} reminders")
@@ -0,0 +1,133 @@
+""" menu screens rendered from MenuCategory and MenuItem"""
+
+from dataclasses import dataclass
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db.models import Prefetch
+from django.template.defaultfilters import floatformat
+
+from .models import MenuCategory, MenuItem
+from .replicas import areplica_reads_for, pin
+from .screens import MAX_SCREEN_OCTETS, Screen, paginate, truncate
+
+MENU_VERSION_KEY = 'ussd:menu:version'
+MENU_PIN = 'menu'
+ITEM_FOOTER = "\n\n0. Back"
+
+
+@dataclass(frozen=True)
+class CompiledMenu:
+    """
+    Every menu screen, rendered and paginated once per menu version
+    """
+    version: int
+    categories_pages: tuple
+    categories: tuple
+    category_pages: dict
+    category_items: dict
+    item_screens: dict
+
+
+def format_price(price):
+    return f"Ksh {floatformat(price, -2)}"
+
+
+def compile_menu(version):
+    """
+    Render all category and item screens in two queries
+    """
+    categories = MenuCategory.objects.filter(is_active=True).order_by('order', 'pk').prefetch_related(
+        Prefetch(
+            'items',
+            queryset=MenuItem.objects.filter(is_available=True).order_by('order', 'pk'),
+        )
+    )
+
+    category_ids = []
+    category_lines = []
+    category_pages = {}
+    category_items = {}
+    item_screens = {}
+
+    for position, category in enumerate(categories, start=1):
+        category_ids.append(category.pk)
+        category_lines.append(f"{position}. {category.name}")
+
+        items = category.items.all()
+        category_pages[category.pk] = paginate(
+            [
+                f"{item_position}. {item.name} - {format_price(item.price)}"
+                for item_position, item in enumerate(items, start=1)
+            ] or ["No items available."],
+            header=[f"{category.name} Menu:"],
+            footer=["0. Back"],
+        )
+        category_items[category.pk] = tuple(item.pk for item in items)
+
+        for item in items:
+            # a long description is what gives way; the back option costs
+            # at most two octets a character, should the text be UCS-2
+            details = Screen(f"{item.name} - {format_price(item.price)}", item.description or None).render()
+            item_screens[item.pk] = Screen(
+                truncate(details, MAX_SCREEN_OCTETS - 2 * len(ITEM_FOOTER)),
+                "",
+                "0. Back",
+            ).render()
+
+    return CompiledMenu(
+        version=version,
+        categories_pages=paginate(
+            category_lines or ["No menu available."],
+            header=["Menu categories:"],
+            footer=["0. Back"],
+        ),
+        categories=tuple(category_ids),
+        category_pages=category_pages,
+        category_items=category_items,
+        item_screens=item_screens,
+    )
+
+
+class MenuEngine:
+    """
+    Serves precompiled menu screens from process memory
+
+    A version counter in the shared 'ussd' cache is bumped whenever a
+    category or item is saved or deleted; the engine recompiles only when
+    it sees a new version, so rendering a menu page costs no queries.
+    """
+
+    def __init__(self, cache_alias='ussd'):
+        self.cache_alias = cache_alias
+        self._compiled = None
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    async def aget(self):
+        """
+        Return the compiled menu, recompiling if the version moved on
+        """
+        version = await self.cache.aget(MENU_VERSION_KEY, 0)
+        compiled = self._compiled
+        if compiled is None or compiled.version != version:
+            # right after a change the replica may not have it yet
+            with await areplica_reads_for(MENU_PIN):
+                compiled = await sync_to_async(compile_menu)(version)
+            self._compiled = compiled
+        return compiled
+
+    def invalidate(self):
+        """
+        Bump the shared menu version so every worker recompiles
+        """
+        pin(MENU_PIN)
+        try:
+            self.cache.incr(MENU_VERSION_KEY)
+        except ValueError:
+            self.cache.set(MENU_VERSION_KEY, 1, None)
+
+
+menu_engine = MenuEngine()
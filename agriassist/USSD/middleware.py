@@ -0,0 +1,47 @@
+""" ussd middleware"""
+
+import random
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.urls import reverse
+
+from .instrumentation import finish_hop, start_hop
+
+
+class UssdMetricsMiddleware:
+    """
+    Measure a sample of USSD callback hops (see instrumentation.py)
+
+    Requests that are not sampled only pay for a path comparison and a
+    random draw.
+    """
+
+    async_capable = True
+    sync_capable = False
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.USSD_METRICS_SAMPLE_RATE
+        self.log = settings.USSD_METRICS_LOG
+        self._path = None
+        markcoroutinefunction(self)
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = reverse('ussd:callback')
+        return self._path
+
+    async def __call__(self, request):
+        if not self.sample_rate or request.path != self.path or random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        hop, token = start_hop()
+        try:
+            response = await self.get_response(request)
+            hop.response_bytes = len(response.content)
+            hop.end = response.content.startswith(b'END')
+            return response
+        finally:
+            finish_hop(hop, token, log=self.log)
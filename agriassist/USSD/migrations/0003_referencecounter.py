@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-18 09:57
+
+from django.db import migrations, models
+
+from agriassist.USSD.references import BLOCK_SIZE, SEQUENCE_NAME
+
+
+def create_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE SEQUENCE IF NOT EXISTS {SEQUENCE_NAME} "
+            f"MINVALUE 0 START WITH 0 INCREMENT BY {BLOCK_SIZE}"
+        )
+
+
+def drop_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"DROP SEQUENCE IF EXISTS {SEQUENCE_NAME}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0002_smsoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('next_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_sequence, drop_sequence),
+    ]
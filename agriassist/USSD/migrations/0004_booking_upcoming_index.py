@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 10:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0003_referencecounter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ussdbooking',
+            index=models.Index(fields=['user', 'booking_date', 'time_slot'], name='ussd_booking_upcoming_idx'),
+        ),
+        migrations.AlterField(
+            model_name='ussdbooking',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='bookings', to='USSD.ussduser'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 6.0 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+from agriassist.USSD.constants import CANCELLED, TIME_SLOTS
+
+
+def count_bookings(apps, schema_editor):
+    """
+    Fill the ledger from the upcoming bookings taken before it existed,
+    with the aggregate capacity.rebuild() uses
+    """
+    SlotCapacity = apps.get_model('USSD', 'SlotCapacity')
+    UssdBooking = apps.get_model('USSD', 'UssdBooking')
+
+    booked = UssdBooking.objects.filter(booking_date__gte=timezone.now().date()).exclude(
+        status=CANCELLED
+    ).values('booking_date', 'time_slot').annotate(seats=models.Sum('party_size')).order_by()
+    reserved = {(row['booking_date'], row['time_slot']): row['seats'] for row in booked}
+
+    SlotCapacity.objects.bulk_create(
+        [
+            SlotCapacity(
+                booking_date=booking_date,
+                time_slot=time_slot,
+                capacity=max(settings.USSD_SLOT_CAPACITY, reserved.get((booking_date, time_slot), 0)),
+                reserved=reserved.get((booking_date, time_slot), 0),
+            )
+            for booking_date in {booking_date for booking_date, _ in reserved}
+            for time_slot, _ in TIME_SLOTS
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0004_booking_upcoming_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotCapacity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('booking_date', models.DateField()),
+                ('time_slot', models.CharField(choices=[('08:00', '08:00 AM - 10:00 AM'), ('11:00', '11:00 AM - 01:00 PM'), ('17:00', '05:00 PM - 07:00 PM'), ('20:00', '08:00 PM - 10:00 PM')], max_length=5)),
+                ('capacity', models.PositiveIntegerField()),
+                ('reserved', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('booking_date', 'time_slot'), name='ussd_slot_capacity_unique'), models.CheckConstraint(condition=models.Q(('reserved__lte', models.F('capacity'))), name='ussd_slot_not_overbooked')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=100, unique=True)),
+                ('party_size', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('slot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='USSD.slotcapacity')),
+            ],
+        ),
+        migrations.RunPython(count_bookings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 6.0 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0005_slot_capacity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UssdSessionArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=100)),
+                ('user_id', models.BigIntegerField()),
+                ('service_code', models.CharField(max_length=20)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('current_menu', models.CharField(blank=True, max_length=50)),
+                ('menu_history', models.JSONField(default=list)),
+                ('temp_data', models.JSONField(default=dict)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='ussdsession',
+            index=models.Index(fields=['started_at'], name='ussd_session_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ussdsessionarchive',
+            index=models.Index(fields=['started_at'], name='ussd_archive_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ussdsessionarchive',
+            index=models.Index(fields=['user_id', 'started_at'], name='ussd_archive_user_idx'),
+        ),
+    ]
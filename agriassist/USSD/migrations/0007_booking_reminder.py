@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0006_session_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ussdbooking',
+            name='reminder_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='ussdbooking',
+            index=models.Index(condition=models.Q(('reminder_sent_at__isnull', True)), fields=['booking_date'], name='ussd_booking_reminder_idx'),
+        ),
+    ]
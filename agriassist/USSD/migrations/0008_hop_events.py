@@ -0,0 +1,55 @@
+# Generated by Django 6.0 on 2026-10-18 15:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0007_booking_reminder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UssdFunnelDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('menu', models.CharField(max_length=50)),
+                ('hops', models.PositiveIntegerField(default=0)),
+                ('visits', models.PositiveIntegerField(default=0)),
+                ('invalid', models.PositiveIntegerField(default=0)),
+                ('completions', models.PositiveIntegerField(default=0)),
+                ('drop_offs', models.PositiveIntegerField(default=0)),
+                ('latency_ms', models.FloatField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'menu'), name='ussd_funnel_daily_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UssdHopEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('session_id', models.CharField(max_length=100)),
+                ('menu', models.CharField(max_length=50)),
+                ('input_class', models.CharField(choices=[('dial', 'Dial'), ('option', 'Option'), ('input', 'Data entry'), ('more', 'Next page'), ('invalid', 'Invalid')], max_length=10)),
+                ('entered', models.BooleanField(default=False)),
+                ('end', models.BooleanField(default=False)),
+                ('latency_ms', models.FloatField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='ussd_hop_created_idx'), models.Index(fields=['session_id', 'id'], name='ussd_hop_session_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 6.0 on 2026-10-18 16:10
+
+import json
+
+import agriassist.USSD.fields
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def pack_states(apps, schema_editor):
+    """
+    Store every state's menu as its id and re-save temp_data, which the
+    field reads back from the old JSON object and writes packed
+    """
+    UssdSessionState = apps.get_model('USSD', 'UssdSessionState')
+    batch = []
+    for state in UssdSessionState.objects.only('current_menu', 'temp_data').iterator(chunk_size=BATCH_SIZE):
+        state.menu = state.current_menu
+        batch.append(state)
+        if len(batch) == BATCH_SIZE:
+            UssdSessionState.objects.bulk_update(batch, ['menu', 'temp_data'])
+            batch = []
+    UssdSessionState.objects.bulk_update(batch, ['menu', 'temp_data'])
+    _check_constraints(schema_editor)
+
+
+def unpack_states(apps, schema_editor):
+    UssdSessionState = apps.get_model('USSD', 'UssdSessionState')
+    batch = []
+    for state in UssdSessionState.objects.only('menu', 'temp_data').iterator(chunk_size=BATCH_SIZE):
+        state.current_menu = state.menu or 'main_menu'
+        # written as is, around the field's encoding
+        state.temp_data = models.Value(json.dumps(state.temp_data), output_field=models.TextField())
+        batch.append(state)
+        if len(batch) == BATCH_SIZE:
+            UssdSessionState.objects.bulk_update(batch, ['current_menu', 'temp_data'])
+            batch = []
+    UssdSessionState.objects.bulk_update(batch, ['current_menu', 'temp_data'])
+    _check_constraints(schema_editor)
+
+
+def _check_constraints(schema_editor):
+    """
+    Run the deferred foreign key checks of the rows just updated now;
+    Postgres refuses to alter a table with checks still pending
+    """
+    schema_editor.connection.check_constraints(table_names=['USSD_ussdsessionstate'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0008_hop_events'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='ussdsessionstate',
+            name='menu_history',
+        ),
+        migrations.RemoveField(
+            model_name='ussdsessionarchive',
+            name='menu_history',
+        ),
+        migrations.AddField(
+            model_name='ussdsessionstate',
+            name='menu',
+            field=agriassist.USSD.fields.MenuField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='ussdsessionstate',
+            name='temp_data',
+            field=agriassist.USSD.fields.StateDataField(default=dict),
+        ),
+        migrations.RunPython(pack_states, unpack_states),
+        migrations.RemoveField(
+            model_name='ussdsessionstate',
+            name='current_menu',
+        ),
+        migrations.RenameField(
+            model_name='ussdsessionstate',
+            old_name='menu',
+            new_name='current_menu',
+        ),
+        migrations.AlterField(
+            model_name='ussdsessionstate',
+            name='current_menu',
+            field=agriassist.USSD.fields.MenuField(default='main_menu'),
+        ),
+    ]
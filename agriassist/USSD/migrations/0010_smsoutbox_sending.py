@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0009_compact_session_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='smsoutbox',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=10),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 6.0 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+def watermark_times(apps, schema_editor):
+    """
+    Move each watermark from the last event folded to that event's time
+    """
+    RollupWatermark = apps.get_model('USSD', 'RollupWatermark')
+    UssdHopEvent = apps.get_model('USSD', 'UssdHopEvent')
+    for watermark in RollupWatermark.objects.filter(position__gt=0):
+        watermark.reached = (
+            UssdHopEvent.objects.filter(pk__lte=watermark.position)
+            .aggregate(reached=models.Max('created_at'))['reached']
+        )
+        watermark.save(update_fields=['reached'])
+
+
+def watermark_positions(apps, schema_editor):
+    RollupWatermark = apps.get_model('USSD', 'RollupWatermark')
+    UssdHopEvent = apps.get_model('USSD', 'UssdHopEvent')
+    for watermark in RollupWatermark.objects.exclude(reached=None):
+        watermark.position = (
+            UssdHopEvent.objects.filter(created_at__lte=watermark.reached)
+            .aggregate(position=models.Max('pk'))['position'] or 0
+        )
+        watermark.save(update_fields=['position'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('USSD', '0010_smsoutbox_sending'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ussdhopevent',
+            name='ussd_hop_session_idx',
+        ),
+        migrations.AddIndex(
+            model_name='ussdhopevent',
+            index=models.Index(fields=['session_id', 'created_at'], name='ussd_hop_session_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='rollupwatermark',
+            name='reached',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(watermark_times, watermark_positions),
+        migrations.RemoveField(
+            model_name='rollupwatermark',
+            name='position',
+        ),
+    ]
@@ -1,9 +1,10 @@
 """ ussd models"""
 
-import random
-import string
 from django.db import models
-from .constants import TIME_SLOTS, STATUS_CHOICES, PENDING
+from django.utils import timezone
+from .constants import TIME_SLOTS, STATUS_CHOICES, PENDING, SMS_STATUS_CHOICES, SMS_QUEUED, HOP_INPUT_CHOICES
+from .fields import MenuField, StateDataField
+from .references import reference_allocator
 
 
 class UssdUser(models.Model):
@@ -26,33 +27,77 @@ class UssdSession(models.Model):
     is_active = models.BooleanField(default=True)
     started_at = models.DateTimeField(auto_now_add=True)
     ended_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the reaper walks the oldest sessions; archiving keeps it short
+            models.Index(fields=['started_at'], name='ussd_session_started_idx'),
+        ]
     
 class UssdSessionState(models.Model):
     """
     Tracks user's position in USSD menu flow
+
+    Both fields are stored compactly (see state_codec.py) and read back
+    as a state name and a dict.
     """
     session = models.OneToOneField(UssdSession, on_delete=models.CASCADE, related_name='state')
-    current_menu = models.CharField(max_length=50, default='main_menu')
-    menu_history = models.JSONField(default=list)  # Stack of previous menus
-    temp_data = models.JSONField(default=dict)  # Store partial booking data
+    current_menu = MenuField(default='main_menu')
+    temp_data = StateDataField(default=dict)  # Store partial booking data
     
+class UssdSessionArchive(models.Model):
+    """
+    Finished session with its final state, moved out of the live tables
+
+    No foreign keys, so archiving never touches or locks live rows.
+    """
+    session_id = models.CharField(max_length=100)
+    user_id = models.BigIntegerField()
+    service_code = models.CharField(max_length=20)
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField(null=True, blank=True)
+    current_menu = models.CharField(max_length=50, blank=True)
+    temp_data = models.JSONField(default=dict)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['started_at'], name='ussd_archive_started_idx'),
+            models.Index(fields=['user_id', 'started_at'], name='ussd_archive_user_idx'),
+        ]
+
 class UssdBooking(models.Model):
     """ 
     Model to store booking information
     """
-    user = models.ForeignKey(UssdUser, on_delete=models.CASCADE, related_name='bookings')
+    # indexed through the leading column of the composite index below
+    user = models.ForeignKey(UssdUser, on_delete=models.CASCADE, related_name='bookings', db_index=False)
     reference_number = models.CharField(max_length=10, unique=True, editable=False)
     booking_date = models.DateField()
     time_slot = models.CharField(max_length=5, choices=TIME_SLOTS)
     party_size = models.IntegerField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
     special_requests = models.TextField(blank=True)
+    reminder_sent_at = models.DateTimeField(null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # upcoming bookings of a user, in display order
+            models.Index(fields=['user', 'booking_date', 'time_slot'], name='ussd_booking_upcoming_idx'),
+            # bookings of a day still due a reminder; shrinks as they are sent
+            models.Index(
+                fields=['booking_date'],
+                condition=models.Q(reminder_sent_at__isnull=True),
+                name='ussd_booking_reminder_idx',
+            ),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.reference_number:
-            self.reference_number = 'BK' + ''.join(random.choices(string.digits, k=6))
+            self.reference_number = reference_allocator.allocate()
         super().save(*args, **kwargs)
 
 class MenuCategory(models.Model):
@@ -73,3 +118,109 @@ class MenuItem(models.Model):
     description = models.TextField(blank=True)
     is_available = models.BooleanField(default=True)
     order = models.IntegerField(default=0)
+
+
+class SmsOutbox(models.Model):
+    """
+    Outgoing SMS waiting to be delivered by the outbox worker
+    """
+    phone_number = models.CharField(max_length=15)
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=SMS_STATUS_CHOICES, default=SMS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+
+class ReferenceCounter(models.Model):
+    """
+    Next free booking reference number, for databases without sequences
+    """
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField(default=0)
+
+
+class SlotCapacity(models.Model):
+    """
+    Seats per (date, time slot), reserved atomically by holds and bookings
+    """
+    booking_date = models.DateField()
+    time_slot = models.CharField(max_length=5, choices=TIME_SLOTS)
+    capacity = models.PositiveIntegerField()
+    reserved = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['booking_date', 'time_slot'], name='ussd_slot_capacity_unique'),
+            models.CheckConstraint(condition=models.Q(reserved__lte=models.F('capacity')), name='ussd_slot_not_overbooked'),
+        ]
+
+
+class SlotHold(models.Model):
+    """
+    Seats held for a session between choosing a party size and confirming
+    """
+    slot = models.ForeignKey(SlotCapacity, on_delete=models.CASCADE, related_name='holds')
+    session_id = models.CharField(max_length=100, unique=True)
+    party_size = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class UssdHopEvent(models.Model):
+    """
+    One handled hop, appended through the hop log buffer (see hop_log.py)
+
+    No foreign keys, so logging never touches or locks live rows.
+    """
+    id = models.BigAutoField(primary_key=True)
+    session_id = models.CharField(max_length=100)
+    # the state shown by the hop, or the one that ended the session
+    menu = models.CharField(max_length=50)
+    input_class = models.CharField(max_length=10, choices=HOP_INPUT_CHOICES)
+    entered = models.BooleanField(default=False)  # the hop moved to `menu`
+    end = models.BooleanField(default=False)
+    latency_ms = models.FloatField()
+    # when the hop was handled, not when its buffer was written
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='ussd_hop_created_idx'),
+            # later hops of a session, to tell where it was abandoned
+            models.Index(fields=['session_id', 'created_at'], name='ussd_hop_session_time_idx'),
+        ]
+
+
+class UssdFunnelDaily(models.Model):
+    """
+    Hops of a day at one state, rolled up from UssdHopEvent
+    """
+    day = models.DateField()
+    menu = models.CharField(max_length=50)
+    hops = models.PositiveIntegerField(default=0)
+    visits = models.PositiveIntegerField(default=0)  # hops that moved to the state
+    invalid = models.PositiveIntegerField(default=0)
+    completions = models.PositiveIntegerField(default=0)  # sessions ended here
+    drop_offs = models.PositiveIntegerField(default=0)  # sessions abandoned here
+    latency_ms = models.FloatField(default=0)  # total, for the mean
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'menu'], name='ussd_funnel_daily_unique'),
+        ]
+
+
+class RollupWatermark(models.Model):
+    """
+    Time up to which source rows are folded into a rollup
+    """
+    name = models.CharField(max_length=50, unique=True)
+    reached = models.DateTimeField(null=True)  # None until the first fold
@@ -0,0 +1,74 @@
+""" read-through cache of ussd user profiles"""
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import UssdUser
+
+PROFILE_FIELDS = ['id', 'phone_number', 'first_name', 'last_name']
+
+
+class ProfileCache:
+    """
+    UssdUser profiles keyed by phone number
+
+    Misses fall through to get_or_create and fill the cache; saving a
+    UssdUser drops its entry (see signals.py). Hits and misses are counted
+    per process.
+    """
+
+    key_prefix = 'ussd:profile:'
+
+    def __init__(self, alias='ussd'):
+        self.alias = alias
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    async def aget(self, phone_number):
+        """
+        Return the UssdUser for a phone number, creating it if needed
+        """
+        user = await self.apeek(phone_number)
+        if user is not None:
+            return user
+
+        user, _ = await UssdUser.objects.aget_or_create(phone_number=phone_number)
+        await self.aset(user)
+        return user
+
+    async def apeek(self, phone_number):
+        """
+        Return the cached UssdUser for a phone number, or None on a miss
+        """
+        profile = await self.cache.aget(self.key_prefix + phone_number)
+
+        if profile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return UssdUser.from_db('default', PROFILE_FIELDS, [profile[name] for name in PROFILE_FIELDS])
+
+    async def aset(self, user):
+        await self.cache.aset(
+            self.key_prefix + user.phone_number,
+            {name: getattr(user, name) for name in PROFILE_FIELDS},
+            settings.USSD_PROFILE_CACHE_TIMEOUT,
+        )
+
+    def invalidate(self, phone_number):
+        self.cache.delete(self.key_prefix + phone_number)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+profile_cache = ProfileCache()
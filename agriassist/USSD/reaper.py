@@ -0,0 +1,92 @@
+""" closing and archiving of finished ussd sessions"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import UssdSession, UssdSessionArchive
+
+ARCHIVED_FIELDS = [
+    'pk', 'session_id', 'user_id', 'service_code', 'started_at', 'ended_at',
+    'state__current_menu', 'state__temp_data',
+]
+
+
+def close_expired_sessions(now=None, reap_after=None, batch_size=5000):
+    """
+    Close sessions the carrier dropped without a final hop
+
+    Returns:
+        int: number of sessions closed
+    """
+    now = now or timezone.now()
+    reap_after = settings.USSD_SESSION_REAP_AFTER if reap_after is None else reap_after
+    expired = UssdSession.objects.filter(
+        started_at__lt=now - timedelta(seconds=reap_after), is_active=True
+    )
+
+    closed = 0
+    while True:
+        # small batches keep every transaction and its row locks short
+        batch = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return closed
+        closed += UssdSession.objects.filter(pk__in=batch, is_active=True).update(
+            is_active=False, ended_at=now
+        )
+
+
+def archive_sessions(now=None, archive_after=None, batch_size=5000):
+    """
+    Move finished sessions and their states to UssdSessionArchive
+
+    Each batch is copied and deleted in one transaction, so a session is
+    always in exactly one of the two tables.
+
+    Returns:
+        int: number of sessions archived
+    """
+    now = now or timezone.now()
+    archive_after = settings.USSD_SESSION_ARCHIVE_AFTER if archive_after is None else archive_after
+    finished = UssdSession.objects.filter(
+        started_at__lt=now - timedelta(seconds=archive_after), is_active=False
+    ).order_by('started_at')
+
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(finished.values(*ARCHIVED_FIELDS)[:batch_size])
+            if not rows:
+                return archived
+
+            UssdSessionArchive.objects.bulk_create([
+                UssdSessionArchive(
+                    session_id=row['session_id'],
+                    user_id=row['user_id'],
+                    service_code=row['service_code'],
+                    started_at=row['started_at'],
+                    ended_at=row['ended_at'],
+                    current_menu=row['state__current_menu'] or '',
+                    temp_data=row['state__temp_data'] or {},
+                )
+                for row in rows
+            ])
+            # deletes the states with the sessions, one statement each
+            UssdSession.objects.filter(pk__in=[row['pk'] for row in rows]).delete()
+            archived += len(rows)
+
+
+def reap(now=None, batch_size=5000):
+    """
+    Close dropped sessions, then archive old finished ones
+
+    Returns:
+        tuple: (sessions closed, sessions archived)
+    """
+    now = now or timezone.now()
+    return (
+        close_expired_sessions(now=now, batch_size=batch_size),
+        archive_sessions(now=now, batch_size=batch_size),
+    )
@@ -0,0 +1,91 @@
+""" booking reference numbers"""
+
+import threading
+
+from django.db import connection, transaction
+
+REFERENCE_PREFIX = 'BK'
+REFERENCE_LENGTH = 8
+
+# Crockford base32: no I, L, O or U, so references read back unambiguously
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+REFERENCE_SPACE = len(ALPHABET) ** REFERENCE_LENGTH  # 2**40
+
+# Odd, so multiplying by it permutes [0, REFERENCE_SPACE): consecutive ids
+# map to unrelated-looking references without ever colliding
+MULTIPLIER = 0x9E3779B97F
+
+# Ids handed to a worker per reservation; the Postgres sequence is created
+# with this increment (migration 0003)
+BLOCK_SIZE = 1000
+SEQUENCE_NAME = 'ussd_booking_reference_seq'
+
+
+def encode_reference(number):
+    """
+    Encode a sequence number as 'BK' + 8 base32 characters
+    """
+    if not 0 <= number < REFERENCE_SPACE:
+        raise ValueError(f"Reference number {number} is out of range")
+
+    value = number * MULTIPLIER % REFERENCE_SPACE
+    chars = []
+    for _ in range(REFERENCE_LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return REFERENCE_PREFIX + ''.join(reversed(chars))
+
+
+class ReferenceAllocator:
+    """
+    Hands out unique booking references from blocks of sequence numbers
+
+    Each worker reserves BLOCK_SIZE numbers at a time, so allocating a
+    reference costs no query at all except once per block, and uniqueness
+    follows from the sequence instead of retries against the unique index.
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.reservations = 0
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self.reserve()
+                self.reservations += 1
+            number = self._next
+            self._next += 1
+        return encode_reference(number)
+
+    def reserve(self):
+        """
+        Reserve the next block of sequence numbers
+
+        Returns:
+            tuple: (first, end) of the reserved range
+        """
+        if connection.vendor == 'postgresql':
+            # nextval() is never rolled back, so a block is never handed out twice
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT nextval(%s)", [SEQUENCE_NAME])
+                start = cursor.fetchone()[0]
+            return start, start + self.block_size
+
+        from .models import ReferenceCounter
+
+        # A counter row is rolled back with the surrounding transaction, so
+        # inside one only reserve the number about to be used
+        size = 1 if connection.in_atomic_block else self.block_size
+        with transaction.atomic():
+            counter, _ = ReferenceCounter.objects.select_for_update().get_or_create(name=SEQUENCE_NAME)
+            start = counter.next_value
+            counter.next_value = start + size
+            counter.save(update_fields=['next_value'])
+        return start, start + size
+
+
+reference_allocator = ReferenceAllocator()
@@ -0,0 +1,83 @@
+""" booking reminders sent the day before"""
+
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .constants import CONFIRMED, PENDING, TIME_SLOTS
+from .models import SmsOutbox, UssdBooking
+from .replicas import replica_reads
+
+SLOT_LABELS = dict(TIME_SLOTS)
+
+
+def render_reminder(booking):
+    """
+    Reminder text of a booking
+
+    The same for every booking of a date and slot, so the outbox sends
+    each slot's reminders in a few multi-recipient gateway calls.
+    """
+    return (
+        f"Reminder: you have a table booked for {booking.booking_date:%d %b %Y}, "
+        f"{SLOT_LABELS.get(booking.time_slot, booking.time_slot)}. "
+        f"Dial the USSD code to view or change your booking."
+    )
+
+
+def send_reminders(day=None, chunk_size=2000):
+    """
+    Queue a reminder for every pending or confirmed booking of `day`
+    (tomorrow by default) that has not had one
+
+    Bookings are streamed through a server-side cursor where the database
+    has one, `chunk_size` at a time; each chunk is queued and marked in
+    one transaction, so a rerun after a crash neither skips nor repeats
+    a reminder. Memory stays bounded by the chunk and every chunk costs
+    three queries, whatever the size of the day.
+
+    Returns:
+        int: number of reminders queued
+    """
+    day = day or timezone.localdate() + timedelta(days=1)
+    due = (
+        UssdBooking.objects.filter(
+            booking_date=day, reminder_sent_at__isnull=True, status__in=[PENDING, CONFIRMED]
+        )
+        .select_related('user')
+        .only('booking_date', 'time_slot', 'user__phone_number')
+        .order_by('pk')
+    )
+
+    queued = 0
+    chunk = []
+    # streamed from the replica; claims are locking reads, on the primary
+    with replica_reads():
+        for booking in due.iterator(chunk_size=chunk_size):
+            chunk.append(booking)
+            if len(chunk) == chunk_size:
+                queued += _queue(chunk)
+                chunk = []
+    if chunk:
+        queued += _queue(chunk)
+    return queued
+
+
+def _queue(bookings):
+    with transaction.atomic():
+        # claim the chunk's rows, so overlapping runs never queue a
+        # reminder twice
+        claimed = set(
+            UssdBooking.objects.select_for_update(skip_locked=True)
+            .filter(pk__in=[booking.pk for booking in bookings], reminder_sent_at__isnull=True)
+            .values_list('pk', flat=True)
+        )
+        SmsOutbox.objects.bulk_create([
+            SmsOutbox(phone_number=booking.user.phone_number, message=render_reminder(booking))
+            for booking in bookings
+            if booking.pk in claimed
+        ])
+        # all rows get the same timestamp, so a plain UPDATE does
+        UssdBooking.objects.filter(pk__in=claimed).update(reminder_sent_at=timezone.now())
+    return len(claimed)
@@ -0,0 +1,86 @@
+""" primary/replica database routing"""
+
+import contextvars
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA = 'replica'
+
+# Set for the blocks whose reads may be served by the replica; the
+# ORM's worker thread inherits it through sync_to_async
+_replica_reads = contextvars.ContextVar('ussd_replica_reads', default=False)
+
+PIN_PREFIX = 'ussd:primary:'
+
+
+def _enabled():
+    return REPLICA in settings.DATABASES
+
+
+class ReplicaRouter:
+    """
+    Sends reads to the replica inside replica_reads() blocks, and
+    everything else to the primary
+
+    Reads are opted in path by path, rather than by model, so code that
+    reads what it is about to write keeps seeing the primary. Locking
+    reads (select_for_update, get_or_create) count as writes and always
+    go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and _enabled():
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return True
+
+
+class replica_reads:
+    """
+    Let the reads of a block go to the replica, unless `active` is false
+    """
+
+    def __init__(self, active=True):
+        self.active = active
+
+    def __enter__(self):
+        self.token = _replica_reads.set(self.active)
+
+    def __exit__(self, *exc_info):
+        _replica_reads.reset(self.token)
+
+
+def pin(key):
+    """
+    Keep reads about `key` (e.g. a user's bookings) on the primary for
+    USSD_REPLICA_PIN_SECONDS, so they see a write the replica may lag on
+
+    Pins are written whether or not this process has a replica: the one
+    writing (e.g. the admin service) may have none configured while the
+    USSD workers reading do.
+    """
+    caches['ussd'].set(PIN_PREFIX + key, True, settings.USSD_REPLICA_PIN_SECONDS)
+
+
+async def apin(key):
+    await caches['ussd'].aset(PIN_PREFIX + key, True, settings.USSD_REPLICA_PIN_SECONDS)
+
+
+async def areplica_reads_for(key):
+    """
+    replica_reads() for reads about `key`: on the primary while it is
+    pinned, with no cache lookup when there is no replica
+
+    Usage: `with await areplica_reads_for(key): ...`
+    """
+    if not _enabled():
+        return replica_reads(False)
+    return replica_reads(not await caches['ussd'].aget(PIN_PREFIX + key, False))
@@ -0,0 +1,169 @@
+""" daily funnel rollups of the hop log"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .constants import HOP_INVALID
+from .models import RollupWatermark, UssdFunnelDaily, UssdHopEvent
+from .replicas import replica_reads
+
+FUNNEL_WATERMARK = 'ussd_funnel_daily'
+COUNTERS = ['hops', 'visits', 'invalid', 'completions', 'drop_offs', 'latency_ms']
+
+# Steps of the flows whose drop-offs dashboards follow
+FUNNELS = {
+    'registration': ['registration', 'registration_last_name', 'registration_confirm'],
+    'booking': [
+        'book_table_menu', 'booking_time_slot', 'booking_party_size',
+        'booking_special_requests', 'booking_confirm',
+    ],
+}
+
+
+def _aggregate(low, high):
+    """
+    Counters per (day, state) of the events created after `low` (None for
+    the first) up to `high`
+
+    Events are written in the order their workers flush them, not the
+    order of their hops, so a session's later hops are told by the time
+    the hop was handled.
+    """
+    later = UssdHopEvent.objects.filter(
+        Q(created_at__gt=OuterRef('created_at')) | Q(created_at=OuterRef('created_at'), pk__gt=OuterRef('pk')),
+        session_id=OuterRef('session_id'),
+    )
+    events = UssdHopEvent.objects.filter(created_at__lte=high)
+    if low is not None:
+        events = events.filter(created_at__gt=low)
+    return (
+        events
+        .annotate(day=TruncDate('created_at'))
+        .values('day', 'menu')
+        .annotate(
+            hops=Count('pk'),
+            visits=Count('pk', filter=Q(entered=True)),
+            invalid=Count('pk', filter=Q(input_class=HOP_INVALID)),
+            completions=Count('pk', filter=Q(end=True)),
+            # the last hop of a session that did not end it
+            drop_offs=Count('pk', filter=~Exists(later) & Q(end=False)),
+            latency_ms=Sum('latency_ms'),
+        )
+        .order_by()
+    )
+
+
+def _add(rows):
+    """
+    Add aggregated counters to their UssdFunnelDaily rows
+    """
+    existing = {
+        (funnel_day.day, funnel_day.menu): funnel_day
+        for funnel_day in UssdFunnelDaily.objects.filter(
+            day__in={row['day'] for row in rows}, menu__in={row['menu'] for row in rows}
+        )
+    }
+    created = []
+    for row in rows:
+        funnel_day = existing.get((row['day'], row['menu']))
+        if funnel_day is None:
+            funnel_day = UssdFunnelDaily(day=row['day'], menu=row['menu'])
+            created.append(funnel_day)
+        for counter in COUNTERS:
+            setattr(funnel_day, counter, getattr(funnel_day, counter) + row[counter])
+
+    UssdFunnelDaily.objects.bulk_update(existing.values(), COUNTERS)
+    UssdFunnelDaily.objects.bulk_create(created)
+
+
+def rollup_hop_events(now=None, batch_size=50000):
+    """
+    Fold settled hop events into UssdFunnelDaily
+
+    Events are read in the order of their hops, from the watermark up to
+    USSD_HOP_EVENT_SETTLE ago, by which time every session they belong to
+    is over, so the last hop of a session can be told apart. Workers
+    write their events within USSD_HOP_EVENT_FLUSH_MS (see hop_log.py),
+    well inside that; an event written later than the settle period
+    after its hop is never counted. Each batch is one aggregate query;
+    its counters are added and the watermark moves in the same
+    transaction, with the watermark row locked, so every event is
+    counted exactly once.
+
+    Returns:
+        int: number of events rolled up
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=settings.USSD_HOP_EVENT_SETTLE)
+
+    rolled_up = 0
+    while True:
+        with transaction.atomic():
+            watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=FUNNEL_WATERMARK)
+            low = watermark.reached
+            if low is not None and low >= cutoff:
+                return rolled_up
+            pending = UssdHopEvent.objects.filter(created_at__lte=cutoff)
+            if low is not None:
+                pending = pending.filter(created_at__gt=low)
+            # the batch ends at its last event's time, ties included
+            high = (
+                pending.order_by('created_at').values_list('created_at', flat=True)[batch_size - 1:batch_size].first()
+                or cutoff
+            )
+            rows = list(_aggregate(low, high))
+            _add(rows)
+            watermark.reached = high
+            watermark.save(update_fields=['reached'])
+        rolled_up += sum(row['hops'] for row in rows)
+        if high == cutoff:
+            return rolled_up
+
+
+def prune_hop_events(now=None, batch_size=5000):
+    """
+    Delete rolled up events older than USSD_HOP_EVENT_RETENTION days
+
+    Returns:
+        int: number of events deleted
+    """
+    now = now or timezone.now()
+    reached = RollupWatermark.objects.filter(name=FUNNEL_WATERMARK).values_list('reached', flat=True).first()
+    if reached is None:
+        return 0
+    expired = UssdHopEvent.objects.filter(
+        created_at__lte=reached, created_at__lt=now - timedelta(days=settings.USSD_HOP_EVENT_RETENTION)
+    )
+
+    deleted = 0
+    while True:
+        batch = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return deleted
+        deleted += UssdHopEvent.objects.filter(pk__in=batch).delete()[0]
+
+
+def funnel(name, since, until=None):
+    """
+    Counters of a funnel's steps summed over days, from the rollup alone,
+    read from the replica
+
+    Returns:
+        list: one dict per step, in funnel order
+    """
+    steps = FUNNELS[name]
+    days = UssdFunnelDaily.objects.filter(day__gte=since, menu__in=steps)
+    if until is not None:
+        days = days.filter(day__lte=until)
+
+    with replica_reads():
+        totals = {
+            row['menu']: row
+            for row in days.values('menu').annotate(**{counter: Sum(counter) for counter in COUNTERS}).order_by()
+        }
+    return [totals.get(step, {'menu': step, **dict.fromkeys(COUNTERS, 0)}) for step in steps]
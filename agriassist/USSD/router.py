@@ -0,0 +1,61 @@
+""" routing of ussd service codes to their flows"""
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .flow import Flow, FlowError
+
+
+class FlowRouter:
+    """
+    Maps each USSD service code to its compiled Flow
+
+    Flows are imported once per worker and picked with a dict lookup.
+    Each flow keeps its own replay memo and precompiled screens, so the
+    traffic of one service code never evicts another's.
+
+    Args:
+        routes: service code -> dotted path of a Flow
+        default: dotted path of the Flow for codes not routed, or None
+            to refuse them
+
+    Raises:
+        FlowError: if a path does not lead to a valid Flow
+    """
+
+    def __init__(self, routes, default=None):
+        self.routes = {service_code: self._load(path) for service_code, path in routes.items()}
+        self.default = self._load(default) if default else None
+
+    @staticmethod
+    def _load(path):
+        flow = import_string(path)
+        if not isinstance(flow, Flow):
+            raise FlowError(f"'{path}' is not a Flow")
+        # flows sharing state names must agree on their ids
+        flow.validate()
+        return flow
+
+    def flow_for(self, service_code):
+        """
+        Returns:
+            Flow: the flow of the code, or None when it has none
+        """
+        return self.routes.get(service_code, self.default)
+
+    def flows(self):
+        """
+        Every distinct flow served
+        """
+        flows = list(self.routes.values()) + ([self.default] if self.default else [])
+        return list({id(flow): flow for flow in flows}.values())
+
+
+@lru_cache(maxsize=None)
+def get_flow_router():
+    """
+    Return the router configured in settings.USSD_FLOWS
+    """
+    return FlowRouter(settings.USSD_FLOWS, settings.USSD_DEFAULT_FLOW)
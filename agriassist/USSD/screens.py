@@ -0,0 +1,143 @@
+""" ussd screen building, size budgeting and pagination"""
+
+# A USSD message carries 160 octets: 182 GSM 7-bit characters, or 80
+# UCS-2 ones as soon as a single character falls outside the GSM alphabet
+MAX_SCREEN_OCTETS = 160
+
+MORE_OPTION = '98'
+MORE_LINE = f"{MORE_OPTION}. More"
+ELLIPSIS = '...'
+
+GSM_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+# escaped characters, two septets each
+GSM_EXTENDED = frozenset("^{}\\[~]|€\f")
+
+
+class Size:
+    """
+    Running encoded size of text, in octets
+
+    Text is sent as GSM 7-bit while every character allows it and as
+    UCS-2 otherwise, so both counts are kept as text is added.
+    """
+    __slots__ = ('septets', 'units', 'ucs2')
+
+    def __init__(self, text=''):
+        self.septets = 0
+        self.units = 0
+        self.ucs2 = False
+        self.add(text)
+
+    def add(self, text):
+        for char in text:
+            if char in GSM_BASIC:
+                self.septets += 1
+            elif char in GSM_EXTENDED:
+                self.septets += 2
+            else:
+                self.ucs2 = True
+        # UTF-16 code units: characters outside the BMP take two
+        self.units += len(text.encode('utf-16-le')) // 2
+        return self
+
+    def plus(self, text):
+        size = Size()
+        size.septets, size.units, size.ucs2 = self.septets, self.units, self.ucs2
+        return size.add(text)
+
+    @property
+    def octets(self):
+        return 2 * self.units if self.ucs2 else (self.septets * 7 + 7) // 8
+
+
+def encoded_octets(text):
+    return Size(text).octets
+
+
+def fits(text, limit=MAX_SCREEN_OCTETS):
+    return encoded_octets(text) <= limit
+
+
+def _cut(text, accept):
+    """
+    Longest prefix of text that, with the ellipsis, is still accepted
+    """
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if accept(text[:middle] + ELLIPSIS):
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + ELLIPSIS
+
+
+def truncate(text, limit=MAX_SCREEN_OCTETS):
+    """
+    Cut text down to the budget, marking the cut
+    """
+    if fits(text, limit):
+        return text
+    return _cut(text, lambda prefix: fits(prefix, limit))
+
+
+class Screen:
+    """
+    Lines of a screen, joined once when rendered
+    """
+
+    def __init__(self, *lines):
+        self.lines = [line for line in lines if line is not None]
+
+    def add(self, *lines):
+        self.lines.extend(line for line in lines if line is not None)
+        return self
+
+    def option(self, key, label):
+        self.lines.append(f"{key}. {label}")
+        return self
+
+    def render(self):
+        return '\n'.join(self.lines)
+
+
+def paginate(items, header=(), footer=(), limit=MAX_SCREEN_OCTETS):
+    """
+    Split item lines into screens that each fit the budget
+
+    Every page shows the header, as many items as fit, "98. More" unless
+    it is the last page, and the footer. Items keep their own numbering,
+    so an option can be picked from any page. Sizes are accumulated in a
+    single pass over the items.
+
+    Returns:
+        tuple: the rendered pages, at least one
+    """
+    header, footer = list(header), list(footer)
+    base = Size('\n'.join(header + footer))
+    more = '\n' + MORE_LINE
+
+    def page(lines, last):
+        return '\n'.join(header + lines + ([] if last else [MORE_LINE]) + footer)
+
+    pages = []
+    current = []
+    size = base
+    for item in items:
+        grown = size.plus('\n' + item)
+        if current and grown.plus(more).octets > limit:
+            pages.append(page(current, last=False))
+            current = []
+            grown = base.plus('\n' + item)
+        if not current and grown.plus(more).octets > limit:
+            # an item too long for any page is cut to fit next to "More"
+            item = _cut(item, lambda prefix: base.plus('\n' + prefix).plus(more).octets <= limit)
+            grown = base.plus('\n' + item)
+        current.append(item)
+        size = grown
+
+    pages.append(page(current, last=True))
+    return tuple(pages)
@@ -0,0 +1,175 @@
+""" ussd session state stores"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .models import UssdSession, UssdSessionState
+from .state_codec import STATE_VERSION, menu_id, menu_name, pack, unpack
+
+
+class BaseSessionStore:
+    """
+    Short-lived home for the state of an in-flight USSD session.
+
+    Sessions live for a couple of minutes at most, so hops read and write
+    their state here instead of the database. Rows are only written when a
+    session ends or when the handler commits something meaningful.
+    """
+
+    def __init__(self, timeout=180):
+        self.timeout = timeout
+
+    def get(self, session_id):
+        raise NotImplementedError
+
+    def set(self, session_id, data):
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    async def aget(self, session_id):
+        return self.get(session_id)
+
+    async def aset(self, session_id, data):
+        self.set(session_id, data)
+
+    async def adelete(self, session_id):
+        self.delete(session_id)
+
+
+class InMemorySessionStore(BaseSessionStore):
+    """
+    Per-process LRU store with a TTL on every entry.
+
+    Only safe when every hop of a session reaches the same process
+    (a single worker or sticky routing).
+    """
+
+    def __init__(self, timeout=180, max_entries=10000):
+        super().__init__(timeout)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= time.monotonic():
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return data
+
+    def set(self, session_id, data):
+        with self._lock:
+            self._entries[session_id] = (time.monotonic() + self.timeout, data)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+
+class CacheSessionStore(BaseSessionStore):
+    """
+    Store backed by one of the configured Django caches, shared by every
+    worker when that cache is Redis.
+    """
+
+    key_prefix = 'ussd:session:'
+
+    def __init__(self, timeout=180, alias='default'):
+        super().__init__(timeout)
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, session_id):
+        return self.cache.get(self.key_prefix + session_id)
+
+    def set(self, session_id, data):
+        self.cache.set(self.key_prefix + session_id, data, self.timeout)
+
+    def delete(self, session_id):
+        self.cache.delete(self.key_prefix + session_id)
+
+    async def aget(self, session_id):
+        return await self.cache.aget(self.key_prefix + session_id)
+
+    async def aset(self, session_id, data):
+        await self.cache.aset(self.key_prefix + session_id, data, self.timeout)
+
+    async def adelete(self, session_id):
+        await self.cache.adelete(self.key_prefix + session_id)
+
+
+@lru_cache(maxsize=None)
+def get_session_store():
+    """
+    Return the store configured in settings.USSD_SESSION_STORE
+    """
+    config = settings.USSD_SESSION_STORE
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+SESSION_FIELDS = ['id', 'session_id', 'user_id', 'service_code']
+
+
+def snapshot(session, state):
+    """
+    Flatten the session and state a hop works with into a flat tuple for
+    the store, led by the state schema version; the session id is the
+    store key and the user comes from the profile cache
+    """
+    return (
+        STATE_VERSION,
+        session.pk,
+        session.user_id,
+        session.service_code,
+        state.pk,
+        menu_id(state.current_menu),
+        pack(state.temp_data),
+    )
+
+
+def restore(data, session_id, user):
+    """
+    Rebuild (session, state) from a snapshot without touching the DB
+
+    The instances are marked as loaded from the database, so saving them
+    issues an UPDATE of the fields they carry.
+
+    Returns:
+        tuple: (session, state), or None for a missing snapshot or one
+        written by a different schema version
+    """
+    if not isinstance(data, tuple) or data[0] != STATE_VERSION:
+        return None
+    _, pk, user_id, service_code, state_pk, state_menu, packed = data
+
+    session = UssdSession.from_db('default', SESSION_FIELDS, [pk, session_id, user_id, service_code])
+    session.user = user
+
+    state = UssdSessionState(
+        id=state_pk,
+        session=session,
+        current_menu=menu_name(state_menu),
+        temp_data=unpack(packed),
+    )
+    # an unsaved state is inserted when the session ends
+    state._state.adding = state_pk is None
+    return session, state
@@ -0,0 +1,43 @@
+""" ussd signal receivers"""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import capacity
+from .constants import CANCELLED
+from .menu_engine import menu_engine
+from .models import MenuCategory, MenuItem, UssdBooking, UssdUser
+from .profile_cache import profile_cache
+
+
+@receiver([post_save, post_delete], sender=MenuCategory)
+@receiver([post_save, post_delete], sender=MenuItem)
+def invalidate_menu(sender, **kwargs):
+    """
+    Recompile menu screens after any category or item change, once it is
+    committed; invalidating earlier would let a concurrent hop cache the
+    rows it replaces
+    """
+    transaction.on_commit(menu_engine.invalidate)
+
+
+@receiver([post_save, post_delete], sender=UssdUser)
+def invalidate_profile(sender, instance, **kwargs):
+    """
+    Drop the cached profile of a user that changed, once the change is
+    committed
+    """
+    transaction.on_commit(lambda: profile_cache.invalidate(instance.phone_number))
+
+
+@receiver(post_delete, sender=UssdBooking)
+def release_deleted_booking(sender, instance, **kwargs):
+    """
+    Give the seats of a deleted booking back to its slot, once the
+    delete is committed
+    """
+    if instance.status != CANCELLED:
+        transaction.on_commit(lambda: capacity.release_booked(
+            instance.booking_date, instance.time_slot, instance.party_size
+        ))
@@ -1,15 +1,257 @@
+""" sms delivery through an outbox"""
+
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from functools import lru_cache
+
 from django.conf import settings
-import africastalking
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+import requests
+from requests.adapters import HTTPAdapter
+
+from .constants import SMS_FAILED, SMS_QUEUED, SMS_SENDING, SMS_SENT
+from .instrumentation import timed_sms
+from .models import SmsOutbox
+
+# Africa's Talking per-recipient status codes that mean the message was accepted
+AT_SUCCESS_CODES = {100, 101, 102}
+
+# (connect, read) timeouts of a gateway call, as the Africa's Talking SDK uses
+GATEWAY_TIMEOUT = (3.05, 9.05)
+
+
+class AfricasTalkingTransport:
+    """
+    Sends messages through the Africa's Talking SMS API
+
+    Calls go through one pooled HTTP session, so consecutive sends reuse
+    a kept-alive TLS connection instead of opening one each; the SDK's
+    `SMS.send` posts through a fresh connection every time.
+    """
+
+    def __init__(self, url=None, username=None, api_key=None, pooled=True):
+        self.url = url or settings.USSD_SMS_GATEWAY_URL
+        self.username = username or settings.AFRICAS_TALKING_USERNAME
+        self.headers = {
+            'Accept': 'application/json',
+            'apiKey': api_key or settings.AFRICAS_TALKING_API_KEY or '',
+        }
+        self.session = None
+        if pooled:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.USSD_SMS_POOL_SIZE)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+    def post(self, data):
+        if self.session is None:
+            return requests.post(self.url, data=data, headers=self.headers, timeout=GATEWAY_TIMEOUT)
+        return self.session.post(self.url, data=data, headers=self.headers, timeout=GATEWAY_TIMEOUT)
+
+    def send(self, message, recipients):
+        """
+        Send one message to many recipients
+
+        Returns:
+            dict: phone number -> error message, or None when accepted
+        """
+        reply = self.post({
+            'username': self.username,
+            'to': ','.join(recipients),
+            'message': message,
+            'bulkSMSMode': 1,
+        })
+        reply.raise_for_status()
+        response = reply.json()
+        results = {phone_number: 'No delivery report' for phone_number in recipients}
+
+        for recipient in response['SMSMessageData']['Recipients']:
+            if recipient['statusCode'] in AT_SUCCESS_CODES:
+                results[recipient['number']] = None
+            else:
+                results[recipient['number']] = recipient['status']
+
+        return results
+
+
+class FakeTransport:
+    """
+    In-memory transport for tests and local runs
+
+    Records every send in `sent`; numbers listed in `failing` are rejected
+    and `latency` simulates a slow gateway.
+    """
+
+    def __init__(self, latency=0, failing=()):
+        self.latency = latency
+        self.failing = set(failing)
+        self.sent = []
+
+    def send(self, message, recipients):
+        if self.latency:
+            time.sleep(self.latency)
+        self.sent.append((message, list(recipients)))
+        return {
+            phone_number: 'Rejected' if phone_number in self.failing else None
+            for phone_number in recipients
+        }
+
+
+class TokenBucket:
+    """
+    Rate limit of gateway calls
+
+    Holds up to `burst` tokens, refilled at `rate` per second; `acquire`
+    sleeps until one is available. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
 
-africastalking.initialize(
-    settings.AFRICAS_TALKING_USERNAME,
-    settings.AFRICAS_TALKING_API_KEY,
-)
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            # the token is spent now; the refill during the wait pays it back
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+
+@lru_cache(maxsize=None)
+def get_bucket():
+    """
+    Gateway rate limit of this process, from settings.USSD_SMS_RATE
+    """
+    return TokenBucket(settings.USSD_SMS_RATE, settings.USSD_SMS_BURST)
+
+
+@lru_cache(maxsize=None)
+def get_transport():
+    """
+    Return the transport configured in settings.USSD_SMS_TRANSPORT
+    """
+    return import_string(settings.USSD_SMS_TRANSPORT)()
 
-sms = africastalking.SMS
 
 def send_sms(phone_number: str, message: str) -> None:
-    sms.send(
-        message = message,
-        recipients = [phone_number],
-    )
\ No newline at end of file
+    """
+    Queue an SMS; the outbox worker delivers it
+    """
+    with timed_sms():
+        SmsOutbox.objects.create(phone_number=phone_number, message=message)
+
+
+async def asend_sms(phone_number: str, message: str) -> None:
+    with timed_sms():
+        await SmsOutbox.objects.acreate(phone_number=phone_number, message=message)
+
+
+def retry_delay(attempts):
+    """
+    Exponential backoff before the next delivery attempt
+    """
+    delay = settings.USSD_SMS_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.USSD_SMS_MAX_RETRY_DELAY))
+
+
+def _claim(now, batch_size):
+    """
+    Lease a batch of due messages to this worker, in a transaction of
+    its own
+
+    Claimed rows move to SMS_SENDING until USSD_SMS_SENDING_TIMEOUT from
+    now. Rows still sending past their lease belong to a worker that
+    stopped mid-delivery: the gateway may or may not have accepted them,
+    so they are failed rather than sent a second time.
+    """
+    with transaction.atomic():
+        SmsOutbox.objects.filter(status=SMS_SENDING, next_attempt_at__lte=now).update(
+            status=SMS_FAILED,
+            attempts=F('attempts') + 1,
+            last_error='Delivery outcome unknown: the worker stopped while sending',
+        )
+        due = list(
+            SmsOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status=SMS_QUEUED, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        SmsOutbox.objects.filter(pk__in=[sms.pk for sms in due]).update(
+            status=SMS_SENDING,
+            next_attempt_at=now + timedelta(seconds=settings.USSD_SMS_SENDING_TIMEOUT),
+        )
+    return due
+
+
+def deliver_pending(transport=None, batch_size=500, bucket=None):
+    """
+    Deliver one batch of due outbox messages
+
+    Recipients of identical messages are sent together, up to
+    USSD_SMS_MAX_RECIPIENTS per gateway call, and every call waits for a
+    token of the rate limit. The batch is claimed with SKIP LOCKED in a
+    short transaction, so several workers can drain the outbox side by
+    side; gateway calls and rate limit waits then run with no
+    transaction open, and the outcome of each message body is recorded
+    as soon as its calls return.
+
+    Returns:
+        int: number of messages processed
+    """
+    transport = transport or get_transport()
+    bucket = bucket or get_bucket()
+    chunk = settings.USSD_SMS_MAX_RECIPIENTS
+    now = timezone.now()
+
+    due = _claim(now, batch_size)
+
+    batches = defaultdict(list)
+    for sms in due:
+        batches[sms.message].append(sms)
+
+    for message, batch in batches.items():
+        recipients = list(dict.fromkeys(sms.phone_number for sms in batch))
+        results = {}
+        for offset in range(0, len(recipients), chunk):
+            part = recipients[offset:offset + chunk]
+            bucket.acquire()
+            try:
+                results.update(transport.send(message, part))
+            except Exception as exc:
+                results.update(dict.fromkeys(part, str(exc) or exc.__class__.__name__))
+
+        finished = timezone.now()
+        for sms in batch:
+            error = results.get(sms.phone_number, 'No delivery report')
+            sms.attempts += 1
+
+            if error is None:
+                sms.status = SMS_SENT
+                sms.sent_at = finished
+                sms.last_error = ''
+            elif sms.attempts >= settings.USSD_SMS_MAX_ATTEMPTS:
+                sms.status = SMS_FAILED
+                sms.last_error = error
+            else:
+                sms.status = SMS_QUEUED
+                sms.next_attempt_at = finished + retry_delay(sms.attempts)
+                sms.last_error = error
+
+        SmsOutbox.objects.bulk_update(
+            batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+        )
+
+    return len(due)
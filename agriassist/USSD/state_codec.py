@@ -0,0 +1,98 @@
+""" compact, versioned encoding of ussd session state
+
+The encoding saves space, not time: a state row takes about half the
+bytes of the JSON object it replaced, but pack() and unpack() are Python
+passes around the same C encoder, so they cost a little more than
+json.dumps() and json.loads() of the dict (see bench_session_state).
+"""
+
+import json
+import zlib
+
+# Flow states are stored as small integer ids derived from their names,
+# so an id means the same state in every flow and every release. A name
+# is decoded once a Flow defining it has been built (see register_menu);
+# an id no flow defines any more decodes to '', which sends the caller
+# back to the flow's entry
+MAX_MENU_ID = 32767
+_MENU_NAMES = {0: ''}
+
+# temp_data keys in encoding order, per schema version. A new version
+# gets a new entry; older ones stay, so stored state keeps decoding.
+SCHEMAS = {
+    1: (
+        'first_name', 'last_name', 'category_id', 'item_id', 'booking_date',
+        'time_slot', 'party_size', 'special_requests', 'page',
+    ),
+}
+STATE_VERSION = max(SCHEMAS)
+STATE_KEYS = SCHEMAS[STATE_VERSION]
+_STATE_KEY_SET = frozenset(STATE_KEYS)
+
+# built once: json.dumps() builds an encoder per call when given options
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def menu_id(name):
+    """
+    Id of a state name, in 1..MAX_MENU_ID; 0 for no state
+    """
+    return zlib.crc32(name.encode()) % MAX_MENU_ID + 1 if name else 0
+
+
+def menu_name(menu_id):
+    return _MENU_NAMES.get(menu_id, '')
+
+
+def register_menu(name):
+    """
+    Make the id of a state decodable
+
+    Raises:
+        ValueError: if the id already stands for another state
+    """
+    registered = _MENU_NAMES.setdefault(menu_id(name), name)
+    if registered != name:
+        raise ValueError(f"States '{registered}' and '{name}' share the id {menu_id(name)}")
+
+
+def pack(data):
+    """
+    temp_data as [version, value, ...] in schema order, without key names
+
+    Trailing unset keys are left out. Keys outside the schema, which a
+    flow may add before the schema catches up, follow as one dict.
+    """
+    packed = [STATE_VERSION]
+    packed.extend([data.get(key) for key in STATE_KEYS])
+    if _STATE_KEY_SET.issuperset(data):
+        while packed[-1] is None:
+            packed.pop()
+    else:
+        packed.append({key: value for key, value in data.items() if key not in _STATE_KEY_SET})
+    return packed
+
+
+def unpack(packed):
+    """
+    Rebuild temp_data from pack()'s output; a plain dict, as stored before
+    the encoding existed, is returned as is
+    """
+    if isinstance(packed, dict):
+        return dict(packed)
+    data = {
+        key: value
+        for key, value in zip(SCHEMAS[packed[0]], packed[1:])
+        if value is not None
+    }
+    if isinstance(packed[-1], dict):
+        data.update(packed[-1])
+    return data
+
+
+def encode(data):
+    return _encoder.encode(pack(data))
+
+
+def decode(text):
+    return unpack(json.loads(text)) if text else {}
@@ -0,0 +1,105 @@
+""" unit of work for a single USSD hop"""
+
+import copy
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+
+class UnitOfWork:
+    """
+    Collects the changes a hop makes to its models and writes them once
+
+    Instances are snapshotted when tracked; flush() compares them against
+    that snapshot and issues at most one INSERT or UPDATE per instance,
+    with update_fields limited to what actually changed, inside a single
+    transaction.
+    """
+
+    def __init__(self):
+        self._tracked = {}
+        self.inserts = Counter()
+        self.updates = Counter()
+
+    def track(self, *instances):
+        """
+        Start tracking instances, remembering their current field values
+        """
+        for instance in instances:
+            self._tracked[id(instance)] = (instance, self._values(instance))
+
+    def discard(self, instance):
+        """
+        Stop tracking an instance so flush() leaves it alone
+        """
+        self._tracked.pop(id(instance), None)
+
+    def dirty_fields(self, instance):
+        """
+        Return the names of fields changed since the instance was tracked
+        """
+        _, snapshot = self._tracked[id(instance)]
+        current = self._values(instance)
+        return [name for name, value in current.items() if snapshot.get(name) != value]
+
+    def pending(self):
+        """
+        Return (instance, update_fields) for everything that needs a write;
+        update_fields is None for instances that still have to be inserted
+        """
+        work = []
+        for instance, _ in self._tracked.values():
+            if instance._state.adding:
+                work.append((instance, None))
+                continue
+            fields = self.dirty_fields(instance)
+            if fields:
+                fields += [
+                    field.name for field in instance._meta.concrete_fields
+                    if getattr(field, 'auto_now', False) and field.name not in fields
+                ]
+                work.append((instance, fields))
+        return work
+
+    def flush(self):
+        """
+        Write every new or changed instance in one transaction
+
+        Returns:
+            int: number of statements issued
+        """
+        return self._write(self.pending())
+
+    async def aflush(self):
+        work = self.pending()
+        if not work:
+            # nothing changed, skip the transaction and the thread hop
+            return 0
+        return await sync_to_async(self._write)(work)
+
+    def _write(self, work):
+        if not work:
+            return 0
+
+        with transaction.atomic():
+            for instance, fields in work:
+                label = instance._meta.label
+                if fields is None:
+                    instance.save()
+                    self.inserts[label] += 1
+                else:
+                    instance.save(update_fields=fields)
+                    self.updates[label] += 1
+                self.track(instance)
+
+        return len(work)
+
+    @staticmethod
+    def _values(instance):
+        deferred = instance.get_deferred_fields()
+        return {
+            field.name: copy.deepcopy(getattr(instance, field.attname))
+            for field in instance._meta.concrete_fields
+            if not field.primary_key and field.attname not in deferred
+        }
@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import ussd_callback
+from .views import metrics, ussd_callback
 
 app_name = 'ussd'
 
 urlpatterns = [
-    path('callback/', ussd_callback),
+    path('callback/', ussd_callback, name='callback'),
+    path('metrics/', metrics, name='metrics'),
 ]
@@ -1,202 +1,209 @@
 """ ussd utility functions"""
 
+import logging
+
+from asgiref.sync import sync_to_async
 from django.utils import timezone
-from agriassist.USSD.constants import TIME_SLOTS
+from agriassist.USSD import capacity
+from agriassist.USSD.availability import availability_index
+from agriassist.USSD.constants import (
+    HOP_DIAL, HOP_INPUT, HOP_INVALID, HOP_MORE, HOP_OPTION, MAX_LISTED_BOOKINGS,
+    TIME_SLOT_LABELS, TIME_SLOTS,
+)
+from agriassist.USSD.flow import PAGE_KEY, Input, UnknownStateError
+from agriassist.USSD.instrumentation import note_menu
+from agriassist.USSD.menu_engine import menu_engine
 from agriassist.USSD.models import UssdBooking
-from agriassist.USSD.sms import send_sms
+from agriassist.USSD.replicas import apin, areplica_reads_for
+from agriassist.USSD.screens import MORE_OPTION, Screen, fits, truncate
+from agriassist.USSD.sms import asend_sms
+from agriassist.USSD.validators import validate_party_size, validate_time_slot
+
+logger = logging.getLogger(__name__)
 
 
 class USSDMenuHandler:
-    def __init__(self, user, session, session_state, text):
+    def __init__(self, user, session, session_state, text, flow, replay_navigation=True):
         """
         Initialize menu handler
-        
+
         Args:
             user: UssdUser instance
             session: UssdSession instance
             session_state: UssdSessionState instance
             text: Full navigation path from AfricasTalking (e.g., "1*2*3")
+            flow: compiled Flow the session walks through
+            replay_navigation: rebuild the current state by replaying `text`
+                through the flow's navigation states instead of trusting
+                session_state.current_menu
+
+        Menus only mutate user and session_state in memory; ussd_callback
+        writes them back once, after the hop has been handled.
         """
         self.user = user
         self.session = session
         self.state = session_state
         self.text = text
-        
+        self.flow = flow
+        self.replay_navigation = replay_navigation
+        self.entry = None
+        # the state that took the input, and the one shown in response
+        self.source = None
+        self.shown = None
+
         # Extract latest user input (last segment after splitting by *)
         # Examples: "" -> "", "1" -> "1", "1*2*3" -> "3"
-        self.user_input = text.split('*')[-1] if text else ''
-        
-        
-    def process(self):
+        self.path = text.split('*') if text else []
+        self.user_input = self.path[-1] if self.path else ''
+
+
+    async def process(self):
         """
         Process user input and return appropriate response menu
-        
+
+        The current state is looked up in the flow's dispatch table, handles
+        the input, and the state it leads to renders the next screen.
+
         Returns:
             tuple: (response_text, is_end)
         """
-                
+
         is_registered = bool(self.user.first_name)
-        
-        if not is_registered:
-            return self.registration_menu()
-        
-        # for registered users
-        menu_method = getattr(self, f"{self.state.current_menu}")
-        
-        if not callable(menu_method):
-            self.current_menu = 'main_menu'
-            self.state.save()
-            menu_method = self.main_menu
-        
-        return menu_method()
-            
-        
-    def registration_menu(self):
-        """
-        Handle user registration flow
-        
-        USER STORY: Display registration welcome message
-        Acceptance Criteria:
-        - Display "Welcome to Curbside Kitchen! You need to register first."
-        - Prompt for first name
-        """
-        
+        entry = self.entry = self.flow.entry_for(self.user)
+
         if not self.text:
-            self.state.current_menu = 'registration'
-            self.state.save()
-            
-            return (
-                "Welcome to AgriAssist!\n"
-                "You need to register first.\n\n"
-                "Enter your first name:",
-                False
-                )
-            
-        
-        # handling registration
-        if 'first_name' not in self.state.temp_data:
-            first_name = self.user_input.strip()
-            
-            if not first_name or not first_name.isalpha():
-                return (
-                    "Invalid input. Please enter a valid first name.",
-                    False
-                    )
-                
-            self.state.temp_data['first_name'] = first_name.title()
-            self.state.save()
-            
-            return (
-                "Enter your last name:",
-                False
-                )
-            
-        if 'last_name' not in self.state.temp_data:
-            last_name = self.user_input.strip()
-            
-            if not last_name or not last_name.isalpha():
-                return (
-                    "Invalid input. Please enter a valid first name.",
-                    False
-                    )
-                
-            self.state.temp_data['last_name'] = last_name.title()
-            self.state.save()
-            
-            full_name = f"{self.state.temp_data['first_name']} {self.state.temp_data['last_name']}"
-            
-            return (
-                f"Confirm registration:\n"
-                f"Name: {full_name}\n"
-                f"Phone: {self.user.phone_number}\n\n"
-                f"1. Confirm\n"
-                f"2. Start Over\n"
-                f"0. Cancel",
-                False
-            )
+            return await self.show(entry)
 
-        if self.user_input == '1':
-            self.user.first_name = self.state.temp_data['first_name']
-            self.user.last_name = self.state.temp_data['last_name']
-            self.user.save()
-            
-            # Clear temp data and update menu
-            self.state.temp_data = {}
-            self.state.current_menu = 'main_menu'
-            self.state.save()
-            
-            return (
-                f"Registration successful!\n"
-                f"Welcome {self.user.first_name}!\n\n"
-                f"Dial again to access our services.",
-                True  # End session
-            )
-            
-        elif self.user_input == '2':
-            self.state.temp_data = {}
-            self.state.save()
-            return self.registration_menu()
-        
+        # Pure navigation is rebuilt from the path; the stored state is only
+        # needed once the path went through data entry
+        current = self.flow.replay(entry, self.path[:-1]) if self.replay_navigation else None
+        if current is None:
+            current = self.state.current_menu
         else:
-            # Cancel registration
-            self.state.temp_data = {}
-            self.state.current_menu = 'main_menu'
-            self.state.save()
-            
-            return (
-                "Registration cancelled.\n"
-                "You need to register to use our services.",
-                True
-            )
-            
-    def main_menu(self):
+            # keep the stored state in step for when data entry follows
+            self.state.current_menu = current
+
+        try:
+            node = self.flow[current]
+        except UnknownStateError:
+            # state left behind by an older version of the flow
+            return await self.show(entry)
+
+        if node.registered and not is_registered:
+            return await self.show(entry)
+
+        note_menu(current)
+        self.source = current
+        if node.paged and self.user_input == MORE_OPTION:
+            self.state.temp_data[PAGE_KEY] = self.page + 1
+            return await self.show(current)
+
+        result = await node.handle(self, self.user_input)
+        if isinstance(result, tuple):
+            return result
+
+        return await self.show(result)
+
+    def is_navigation(self):
+        """
+        Whether this hop can be rebuilt from the text path alone, in which
+        case its state does not need to be stored
+        """
+        return (
+            self.replay_navigation
+            and self.entry is not None
+            and self.flow.replay(self.entry, self.path) is not None
+        )
+
+    def input_class(self, is_end):
+        """
+        What the input of this hop was, for the hop log
         """
-        Handle main menu
-        
-        USER STORY: Display main menu
+        if self.source is None:
+            return HOP_DIAL
+        node = self.flow[self.source]
+        if node.paged and self.user_input == MORE_OPTION:
+            return HOP_MORE
+        if self.shown is None and not is_end:
+            # answered in place: an invalid option or a rejected value
+            return HOP_INVALID
+        return HOP_INPUT if isinstance(node, Input) else HOP_OPTION
+
+    @property
+    def menu(self):
+        """
+        The state shown by this hop, or the one that ended the session
+        """
+        return self.shown or self.source
+
+    @property
+    def page(self):
+        """
+        Page of the current state's screen being shown, from 0
+        """
+        return self.state.temp_data.get(PAGE_KEY, 0)
+
+    async def show(self, name):
+        """
+        Move to a state and render its screen
+        """
+        node = self.flow[name]
+        note_menu(name)
+        self.shown = name
+        if name != self.state.current_menu:
+            self.state.temp_data.pop(PAGE_KEY, None)
+        self.state.current_menu = name
+
+        text, is_end = await node.render(self)
+        if not fits(text):
+            # the carrier would cut it anyway, and maybe mid-option
+            logger.warning("Screen of '%s' is over the USSD size budget", name)
+            text = truncate(text)
+        return (text, is_end)
+
+
+    async def confirm_registration(self):
+        """
+        Handle registration confirmation
+
+        USER STORY: Complete registration
         Acceptance Criteria:
-        - Display "Welcome to Curbside Kitchen!"
-        - List main menu options
+        - Save the user's names
+        - Display "Registration successful!" and end the session
         """
-        if not self.text or self.text == '':
-            return (
-                f"Welcome {self.user.first_name}!\n\n"
-                f"1. View Menu\n"
-                f"2. Book Table\n"
-                f"3. My Bookings\n"
-                f"4. Contact Us\n"
-                f"0. Exit",
-                False
-            )
-            
-        if self.user_input == '1':
-            self.state.current_menu = 'view_menu'
-            self.state.save()
-            return self.view_menu()
-        elif self.user_input == '2':
-            self.state.current_menu = 'book_table_menu'
-            self.state.save()
-            return self.book_table_menu()
-        elif self.user_input == '3':
-            self.state.current_menu = 'my_bookings'
-            self.state.save()
-            return self.my_bookings_menu()
-        elif self.user_input == '4':
-            self.state.current_menu = 'contact_us'
-            self.state.save()
-            return self.view_menu() 
-        elif self.user_input == '0':
-            return(
-                "Operation cancelled.\n",
-                True
-            )
-        else:
-            return (
-                "Invalid option. Please try again.",
-                False
-            )
-            
-    def view_menu(self):
+        self.user.first_name = self.state.temp_data['first_name']
+        self.user.last_name = self.state.temp_data['last_name']
+
+        # Clear temp data and update menu
+        self.state.temp_data = {}
+        self.state.current_menu = self.flow.initial
+
+        return (
+            f"Registration successful!\n"
+            f"Welcome {self.user.first_name}!\n\n"
+            f"Dial again to access our services.",
+            True  # End session
+        )
+
+    async def restart_registration(self):
+        self.state.temp_data = {}
+        return self.flow.unregistered
+
+    async def cancel_registration(self):
+        self.state.temp_data = {}
+        self.state.current_menu = self.flow.initial
+
+        return (
+            "Registration cancelled.\n"
+            "You need to register to use our services.",
+            True
+        )
+
+    async def menu_categories(self):
+        menu = await menu_engine.aget()
+        return menu.categories
+
+    async def view_menu_screen(self):
         """
         Handle view menu
 
@@ -205,239 +212,182 @@ class USSDMenuHandler:
         - Display "View Menu"
         - List menu options
         """
-        # Check if we just entered this menu
-        if 'view_menu_shown' not in self.state.temp_data:
-            self.state.temp_data['view_menu_shown'] = True
-            self.state.save()
-            return (
-                "Menu categories:\n"
-                "1. Breakfast\n"
-                "2. Appetizers\n"
-                "3. Drinks\n"
-                "4. Main Dishes\n"
-                "0. Back",
-                False
-            )
+        menu = await menu_engine.aget()
+        pages = menu.categories_pages
+        return pages[min(self.page, len(pages) - 1)]
 
-        # Clear the flag and handle selection
-        del self.state.temp_data['view_menu_shown']
-        self.state.save()
-
-        if self.user_input == '1':
-            self.state.current_menu = 'breakfast_menu'
-            self.state.save()
-            return self.breakfast_menu()
-        elif self.user_input == '2':
-            self.state.current_menu = 'appetizers_menu'
-            self.state.save()
-            return self.appetizers_menu()
-        elif self.user_input == '3':
-            self.state.current_menu = 'drinks_menu'
-            self.state.save()
-            return self.drinks_menu()
-        elif self.user_input == '4':
-            self.state.current_menu = 'main_dishes_menu'
-            self.state.save()
-            return self.main_dishes_menu()
-        elif self.user_input == '0':
-            self.state.current_menu = 'main_menu'
-            self.state.save()
-            return self.main_menu()
-        else:
-            return (
-                "Invalid option. Please try again.",
-                False
+    async def category_items(self):
+        menu = await menu_engine.aget()
+        return menu.category_items.get(self.state.temp_data.get('category_id'), ())
+
+    async def category_menu_screen(self):
+        """
+        Handle a menu category
+
+        USER STORY: Display the items of a menu category
+        Acceptance Criteria:
+        - Display "<Category> Menu"
+        - List available items with prices
+        """
+        menu = await menu_engine.aget()
+        pages = menu.category_pages.get(self.state.temp_data.get('category_id'))
+        if pages is None:
+            return "This category is no longer available.\n0. Back"
+        return pages[min(self.page, len(pages) - 1)]
+
+    async def item_menu_screen(self):
+        """
+        Handle a menu item
+
+        USER STORY: Display menu item details
+        Acceptance Criteria:
+        - Display item name, price and description
+        """
+        menu = await menu_engine.aget()
+        return menu.item_screens.get(
+            self.state.temp_data.pop('item_id', None),
+            "This item is no longer available.\n\n0. Back",
+        )
+
+    async def time_slot_screen(self):
+        """
+        Handle time slot selection
+
+        USER STORY: Pick a time slot
+        Acceptance Criteria:
+        - List the time slots with the seats left in each
+        - Mark slots with no seats left as full
+        """
+        seats = await availability_index.aget(self.state.temp_data['booking_date'])
+
+        screen = Screen("Available time slots:", "")
+        for number, (time_slot, _) in enumerate(TIME_SLOTS, start=1):
+            label, left = TIME_SLOT_LABELS[time_slot], seats[time_slot]
+            screen.option(number, f"{label} ({left} left)" if left > 0 else f"{label} (Full)")
+        return screen.add("", "Enter booking time slot:").render()
+
+    async def check_time_slot(self, value):
+        time_slot = validate_time_slot(value)
+        seats = await availability_index.aget(self.state.temp_data['booking_date'])
+        if seats[time_slot] <= 0:
+            raise ValueError("This time slot is full. Please pick another one.")
+        return time_slot
+
+    async def hold_party_size(self, value):
+        """
+        Hold the seats for the party until the booking is confirmed
+
+        The hold expires after USSD_SLOT_HOLD_SECONDS if the caller walks
+        away, so abandoned sessions do not keep seats from others.
+        """
+        party_size = validate_party_size(value)
+        data = self.state.temp_data
+
+        held = await sync_to_async(capacity.hold_seats)(
+            self.session.session_id, data['booking_date'], data['time_slot'], party_size
+        )
+        if not held:
+            seats = await availability_index.aget(data['booking_date'])
+            raise ValueError(
+                f"Only {max(seats[data['time_slot']], 0)} seats left in this time slot. "
+                f"Enter number of people:"
             )
-        
-        
-        
-    def book_table_menu(self):
+        return party_size
+
+    async def confirm_booking(self):
         """
-        Handle book table
-        
+        Handle booking confirmation
+
         USER STORY: Book table
         Acceptance Criteria:
-        - Display "Book Table"
-        - Prompt for date and time
+        - Create the booking from the details entered, against the seats
+          held for it
+        - Display "Booking successful!" and end the session
+        - Display "Time slot fully booked" if the seats were lost meanwhile
         """
-        if 'book_table_menu' not in self.state.temp_data:
-            self.state.temp_data['book_table_menu'] = True
-            self.state.save()
-            return(
-                "Booking Information:\n"
-                "Enter booking date (YYYY-MM-DD):",
-                False
-            )
-        
-        if 'booking_date' not in self.state.temp_data:
-            booking_date = self.user_input.strip()
-            self.state.temp_data['booking_date'] = booking_date
-            self.state.save()
-            
-            slots = [f"{time}. {display}" for time, (_, display) in enumerate(TIME_SLOTS, start=1)]
-            return(
-                "Available time slots:\n\n" + "\n".join(slots) + "\n\nEnter booking time slot:",
-                False
-            )
-        
-        if 'time_slot' not in self.state.temp_data:
-            time_mapping = {str(time): time_value for time, (time_value, _) in enumerate(TIME_SLOTS, start=1)}
-            if self.user_input not in time_mapping:
-                return(
-                    "Invalid time slot. Please try again.",
-                    False
-                )
-            time_slot = time_mapping[self.user_input]
-            self.state.temp_data['time_slot'] = time_slot
-            self.state.save()
-            return(
-                "Enter number of people:",
-                False
-            )
-        
-        if 'party_size' not in self.state.temp_data:
-            party_size = self.user_input.strip()
-            self.state.temp_data['party_size'] = party_size
-            self.state.save()
-            return(
-                "Write any special requests:",
-                False
-            )
-            
-        if 'special_requests' not in self.state.temp_data:
-            special_requests = self.user_input.strip()
-            self.state.temp_data['special_requests'] = special_requests
-            self.state.save()
-            return(
-                "Confirm booking:\n"
-                f"Name: {self.user.first_name} {self.user.last_name}\n"
-                f"Booking Date: {self.state.temp_data['booking_date']}\n"
-                "1. Confirm\n"
-                "2. Edit\n"
-                "0. Cancel",
-                False
-            )
-            
-        if self.user_input == '1':
-            booking = UssdBooking.objects.create(
-                user = self.user,
-                booking_date = self.state.temp_data['booking_date'],
-                time_slot = self.state.temp_data['time_slot'],
-                party_size = self.state.temp_data['party_size'],
-                special_requests = self.state.temp_data['special_requests']
-            )
-            
-            # Clear temp data and update menu
-            self.state.temp_data = {}
-            self.state.current_menu = 'main_menu'
-            self.state.save()
-            
-            return(
-                "Booking successful!\n"
-                "Thank you for booking with us.",
-                True
-            )
-            
-        elif self.user_input == '2':
-            self.state.temp_data = {}
-            self.state.save()
-            return self.book_table_menu()
-        
-        else:            
-            return(
-                "Booking cancelled.\n",
+        booking = await sync_to_async(capacity.confirm_booking)(
+            self.session.session_id,
+            user = self.user,
+            booking_date = self.state.temp_data['booking_date'],
+            time_slot = self.state.temp_data['time_slot'],
+            party_size = self.state.temp_data['party_size'],
+            special_requests = self.state.temp_data['special_requests']
+        )
+
+        # Clear temp data and update menu
+        self.state.temp_data = {}
+        self.state.current_menu = self.flow.initial
+
+        if booking is None:
+            return (
+                "Sorry, this time slot is now fully booked.\n"
+                "Please dial again to pick another one.",
                 True
             )
-            
-    def my_bookings_menu(self):
+
+        # the caller's next My Bookings must see it, lagging replica or not
+        await apin(f"bookings:{self.user.pk}")
+
+        return(
+            "Booking successful!\n"
+            "Thank you for booking with us.",
+            True
+        )
+
+    async def restart_booking(self):
+        await sync_to_async(capacity.release_hold)(self.session.session_id)
+        self.state.temp_data = {}
+        return 'book_table_menu'
+
+    async def cancel_booking(self):
+        await sync_to_async(capacity.release_hold)(self.session.session_id)
+        return(
+            "Booking cancelled.\n",
+            True
+        )
+
+    async def my_bookings_screen(self):
         """
         Handle my bookings
-        
+
         USER STORY: View bookings
         Acceptance Criteria:
         - Display "My Bookings"
         - List bookings
         """
-            
+
+        # one query on the (user, booking_date, time_slot) index, fetching
+        # only what is rendered, from the replica unless the caller just
+        # booked
         bookings = UssdBooking.objects.filter(
             user=self.user,
             booking_date__gte=timezone.now().date()
-        ).order_by('booking_date', 'time_slot')
-        
-        if not bookings.exists():
+        ).order_by('booking_date', 'time_slot').only(
+            'booking_date', 'time_slot', 'party_size', 'status', 'reference_number'
+        )[:MAX_LISTED_BOOKINGS]
+        with await areplica_reads_for(f"bookings:{self.user.pk}"):
+            bookings = [booking async for booking in bookings]
+
+        if not bookings:
             return (
                 "You have no upcoming bookings.\n\n"
-                "Book a table from the main menu!",
-                True
+                "Book a table from the main menu!"
             )
-        
-        response = "Your Upcoming Bookings:\n\n"
-        
+
+        # an SMS, so not bound by the screen budget
+        message = Screen("Your Upcoming Bookings:", "")
+        time_slots = dict(TIME_SLOTS)
         for booking in bookings:
-            time_display = dict(TIME_SLOTS).get(booking.time_slot, booking.time_slot)
-            
-            response += (
-                f"Booking Data: {booking.booking_date}\n"
-                f"Time:{time_display}\n"
-                f"Persons: {booking.party_size} guests\n"
-                f"Status:{booking.status}"
-                f"Ref: {booking.reference_number}\n\n"
+            message.add(
+                f"Booking Data: {booking.booking_date}",
+                f"Time:{time_slots.get(booking.time_slot, booking.time_slot)}",
+                f"Persons: {booking.party_size} guests",
+                f"Status:{booking.status}",
+                f"Ref: {booking.reference_number}",
+                "",
             )
-        
-        response += "For changes call:\n+88-123-123456"
-        
-        send_sms(self.user.phone_number, response)
-        
-        return (
-            'Message sent successfully',
-            True
-        )
-            
-            
-    def breakfast_menu(self):
-        """
-        Handle breakfast menu
-        
-        USER STORY: Display breakfast menu
-        Acceptance Criteria:
-        - Display "Breakfast Menu"
-        - List breakfast options
-        """
-        if 'breakfast_menu_shown' not in self.state.temp_data:
-            self.state.temp_data['breakfast_menu_shown'] = True
-            self.state.save()
-            return (
-                "Breakfast Menu:\n"
-                "1. Eggs Benedict - Ksh 500\n"
-                "2. Pancakes - Ksh 400\n"
-                "3. French Toast - Ksh 300\n"
-                "0. Back",
-                False
-            )
-        
-        # Clear the flag and handle selection
-        del self.state.temp_data['breakfast_menu_shown']
-        self.state.save()
-            
-        if self.user_input == '1':
-            self.state.current_menu = 'eggs_benedict'
-            self.state.save()
-            return self.eggs_benedict()
-        if self.user_input == '2':
-            self.state.current_menu = 'pancakes'
-            self.state.save()
-            return self.pancakes()
-        if self.user_input == '3':
-            self.state.current_menu = 'french_toast'
-            self.state.save()
-            return self.french_toast()
-        if self.user_input == '0':
-            self.state.current_menu = 'view_menu'
-            self.state.save()
-            return self.view_menu()
-        else:
-            return (
-                "Invalid option. Please try again.",
-                False
-            )
-        
\ No newline at end of file
+        message.add("For changes call:", "+88-123-123456")
+
+        await asend_sms(self.user.phone_number, message.render())
+
+        return 'Message sent successfully'
@@ -0,0 +1,44 @@
+""" ussd input validators
+
+Each validator returns the cleaned value or raises ValueError with the
+message to show the caller.
+"""
+
+from datetime import date
+
+from django.utils import timezone
+
+from .constants import TIME_SLOTS
+
+MAX_PARTY_SIZE = 50
+
+
+def name_validator(label):
+    def validate(value):
+        if not value or not value.isalpha():
+            raise ValueError(f"Invalid input. Please enter a valid {label} name.")
+        return value.title()
+    return validate
+
+
+def validate_booking_date(value):
+    try:
+        booking_date = date.fromisoformat(value)
+    except ValueError:
+        raise ValueError("Invalid date. Enter booking date (YYYY-MM-DD):") from None
+    if booking_date < timezone.now().date():
+        raise ValueError("Date is in the past. Enter booking date (YYYY-MM-DD):")
+    return booking_date.isoformat()
+
+
+def validate_time_slot(value):
+    time_mapping = {str(time): time_value for time, (time_value, _) in enumerate(TIME_SLOTS, start=1)}
+    if value not in time_mapping:
+        raise ValueError("Invalid time slot. Please try again.")
+    return time_mapping[value]
+
+
+def validate_party_size(value):
+    if not value.isdigit() or not 1 <= int(value) <= MAX_PARTY_SIZE:
+        raise ValueError(f"Invalid number. Enter number of people (1-{MAX_PARTY_SIZE}):")
+    return int(value)
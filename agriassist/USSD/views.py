@@ -1,6 +1,17 @@
+import time
+
+from django.conf import settings
 from django.utils import timezone
 from django.shortcuts import render
-from .models import UssdSession, UssdSessionState, UssdUser
+from .bootstrap import abootstrap
+from .hop_log import hop_log
+from .idempotency import response_cache
+from .instrumentation import note_menu, registry
+from .models import UssdSession, UssdSessionState
+from .profile_cache import profile_cache
+from .router import get_flow_router
+from .session_store import get_session_store, restore, snapshot
+from .unit_of_work import UnitOfWork
 from .utils import USSDMenuHandler
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse
@@ -13,10 +24,13 @@ Expected POST data:
 - serviceCode: USSD code dialed (e.g., *384*123#)
 - phoneNumber: User's phone number (+254XXXXXXXXX)
 - text: User's navigation path (e.g., "1*2*3")
+
+Runs natively on the event loop under the uvicorn worker, so a slow
+database or SMS gateway parks a coroutine instead of a thread.
 '''
 
 @csrf_exempt
-def ussd_callback(request):
+async def ussd_callback(request):
     if request.method != "POST":
         return HttpResponse("END Invalid request", content_type="text/plain")
     
@@ -30,39 +44,138 @@ def ussd_callback(request):
     if not all([session_id, service_code, phone_number]):
         return HttpResponse("END Invalid request", content_type="text/plain")
     
-    # get or create session and state and get user
-    user, _ = UssdUser.objects.get_or_create(phone_number=phone_number)
-    session, _ = UssdSession.objects.get_or_create(
-        session_id=session_id, 
-        defaults={
-            'user': user,
-            'service_code': service_code,
-            'is_active': True,
-        }
-    )
+    flow = get_flow_router().flow_for(service_code)
+    if flow is None:
+        return HttpResponse("END Service unavailable", content_type="text/plain")
+    
+    # A carrier retry of a hop gets the response of the first attempt
+    # instead of applying the same input twice
+    claimed, response = await response_cache.aclaim(session_id, text or '')
+    if not claimed:
+        note_menu('retry')
+        if response is None:
+            # the first attempt is still running after waiting as long as
+            # the gateway does; only CON or END reach the caller
+            return HttpResponse(
+                "END Your request is taking longer than expected. Please dial again shortly.",
+                content_type="text/plain",
+            )
+        return HttpResponse(response, content_type="text/plain")
+    
+    try:
+        response = await handle_hop(flow, session_id, service_code, phone_number, text)
+    except BaseException:
+        await response_cache.arelease(session_id, text or '')
+        raise
+    await response_cache.aset(session_id, text or '', response)
+    
+    return HttpResponse(response, content_type="text/plain")
+
+
+async def handle_hop(flow, session_id, service_code, phone_number, text):
+    """
+    Run one hop through the flow of its service code
+
+    Returns:
+        str: the response body, prefixed with CON or END
+    """
+    started = time.perf_counter()
+    store = get_session_store()
+    session = session_state = cached = None
+    
+    user = await profile_cache.apeek(phone_number)
+    if user is None:
+        # new caller or cold cache: user, session and state in one go
+        user, session, session_state = await abootstrap(phone_number, session_id, service_code)
+        await profile_cache.aset(user)
+    
+    # Pure navigation hops are rebuilt from `text` alone and need neither
+    # the stored session state nor any write
+    target = None
+    if settings.USSD_REPLAY_NAVIGATION and text:
+        target = flow.replay(flow.entry_for(user), text.split('*'))
+    navigation_only = target is not None and not flow[target].end
     
-    session_state, _ = UssdSessionState.objects.get_or_create(
-        session=session, 
-        defaults={
-            'current_menu': 'main_menu',
-            'menu_history': [],
-            'temp_data': {}
-        }
+    if navigation_only:
+        if session is None:
+            # transient instances: nothing from this hop is stored
+            session = UssdSession(session_id=session_id, user=user, service_code=service_code)
+            session_state = UssdSessionState(session=session, temp_data={})
+    elif (cached := restore(await store.aget(session_id), session_id, user)) is not None:
+        # hops after the first one are served from the session store,
+        # which is ahead of anything bootstrapped from the database
+        session, session_state = cached
+    elif session is None:
+        # first hop, or a store that lost the session: one query for a
+        # known session, its insert for a new one
+        _, session, session_state = await abootstrap(phone_number, session_id, service_code, user)
+    
+    if session_state is None:
+        # the state row only exists once a session has ended
+        session_state = UssdSessionState(
+            session=session,
+            current_menu='main_menu',
+            temp_data={},
+        )
+    
+    handler = USSDMenuHandler(
+        user, session, session_state, text, flow,
+        replay_navigation=settings.USSD_REPLAY_NAVIGATION,
     )
     
-    handler = USSDMenuHandler(user, session, session_state, text)
-    response_text, is_end = handler.process()
+    if navigation_only:
+        response_text, is_end = await handler.process()
+        await log_hop(handler, is_end, started)
+        return "CON " + response_text
+    
+    unit_of_work = UnitOfWork()
+    unit_of_work.track(user, session, session_state)
     
-    # Update session if ended
+    response_text, is_end = await handler.process()
+    
+    # Persist the session only once it has ended
     if is_end:
         session.is_active = False
         session.ended_at = timezone.now()
-        session.save()
+        await store.adelete(session_id)
+    else:
+        data_changed = set(unit_of_work.dirty_fields(session_state)) - {'current_menu'}
+        unit_of_work.discard(session_state)
+        # pure navigation hops are replayed from `text` next time, so
+        # only the first hop and data entry need to reach the store
+        if cached is None or data_changed or not handler.is_navigation():
+            await store.aset(session_id, snapshot(session, session_state))
+    
+    # One flush per hop: at most one write per model, in one transaction
+    await unit_of_work.aflush()
+    await log_hop(handler, is_end, started)
     
     # Format response for AfricasTalking
     # CON = Continue (show menu and wait for input)
     # END = End session (final message)
     response_prefix = "END " if is_end else "CON "
     
-    # Return plain text response
-    return HttpResponse(response_prefix + response_text, content_type="text/plain")
+    return response_prefix + response_text
+
+
+async def log_hop(handler, is_end, started):
+    await hop_log.arecord(
+        handler.session.session_id,
+        handler.menu,
+        handler.input_class(is_end),
+        entered=handler.shown is not None and handler.shown != handler.source,
+        end=is_end,
+        latency=time.perf_counter() - started,
+    )
+
+
+def metrics(request):
+    """
+    Hop histograms of this worker in the Prometheus text format
+
+    When USSD_METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+    token = settings.USSD_METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return HttpResponse("Unauthorized", status=401, content_type="text/plain")
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
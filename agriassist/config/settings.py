@@ -36,6 +36,24 @@ ALLOWED_HOSTS = os.getenv("ALLOWED_HOSTS", "").split(",")
 AFRICAS_TALKING_API_KEY = os.getenv("AFRICAS_TALKING_API_KEY")
 AFRICAS_TALKING_USERNAME = os.getenv("AFRICAS_TALKING_USERNAME")
 
+# SMS outbox delivery (see `manage.py process_sms_outbox`)
+USSD_SMS_TRANSPORT = os.getenv("USSD_SMS_TRANSPORT", 'agriassist.USSD.sms.AfricasTalkingTransport')
+USSD_SMS_MAX_ATTEMPTS = 5
+USSD_SMS_RETRY_DELAY = 30  # seconds, doubled after every failed attempt
+USSD_SMS_MAX_RETRY_DELAY = 3600
+# Seconds a worker may take to send a claimed batch; messages it has not
+# reported on by then are failed rather than risk being sent twice
+USSD_SMS_SENDING_TIMEOUT = 900
+# Gateway endpoint (the sandbox is at
+# https://api.sandbox.africastalking.com/version1/messaging), calls per
+# second and burst allowed to each outbox worker (a rate of 0 turns the
+# limit off), recipients per call and HTTP connections kept alive
+USSD_SMS_GATEWAY_URL = os.getenv("USSD_SMS_GATEWAY_URL", 'https://api.africastalking.com/version1/messaging')
+USSD_SMS_RATE = float(os.getenv("USSD_SMS_RATE", "10"))
+USSD_SMS_BURST = 20
+USSD_SMS_MAX_RECIPIENTS = 1000
+USSD_SMS_POOL_SIZE = 2
+
 
 # Application definition
 
@@ -51,6 +69,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # outermost, so a sampled hop's wall time covers the whole stack
+    'agriassist.USSD.middleware.UssdMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -134,3 +154,105 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # Enable the WhiteNoise storage backend, which compresses static files to reduce disk use
 # and renames the files with unique names for each version to support long-term caching
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+
+# Caches
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by every worker when REDIS_URL is set
+    'ussd': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ussd',
+    },
+}
+
+
+# USSD session state
+# In-flight session state lives in this store and only reaches the
+# database when a session ends. Use the in-memory store only with a
+# single worker, as hops of one session may land on any worker.
+
+USSD_SESSION_STORE = {
+    'BACKEND': 'agriassist.USSD.session_store.CacheSessionStore',
+    'OPTIONS': {
+        'alias': 'ussd',
+        'timeout': int(os.getenv("USSD_SESSION_TIMEOUT", "180")),
+    },
+}
+
+# Seconds a caller's profile stays in the 'ussd' cache
+USSD_PROFILE_CACHE_TIMEOUT = 3600
+
+# Rebuild pure navigation from AfricasTalking's `text` path instead of
+# reading and writing the stored state on every hop
+USSD_REPLAY_NAVIGATION = True
+
+# Seats per booking time slot, and how long seats stay held for a session
+# that has entered its party size but not confirmed yet
+USSD_SLOT_CAPACITY = int(os.getenv("USSD_SLOT_CAPACITY", "40"))
+USSD_SLOT_HOLD_SECONDS = 300
+
+# Seconds a date's seat availability stays in the 'ussd' cache; entries
+# are rewritten on every booking change, this only bounds staleness
+USSD_AVAILABILITY_TIMEOUT = 300
+
+# Sessions still active this many seconds after they started were dropped
+# by the carrier and are closed by reap_ussd_sessions; finished sessions
+# move to UssdSessionArchive after USSD_SESSION_ARCHIVE_AFTER seconds
+USSD_SESSION_REAP_AFTER = 600
+USSD_SESSION_ARCHIVE_AFTER = 24 * 3600
+
+# Fraction of USSD hops measured by UssdMetricsMiddleware (0 turns it off)
+# and exported at /ussd/metrics/; USSD_METRICS_LOG also writes one JSON
+# line per measured hop to the 'agriassist.ussd.hops' logger
+USSD_METRICS_SAMPLE_RATE = float(os.getenv("USSD_METRICS_SAMPLE_RATE", "0.1"))
+USSD_METRICS_LOG = os.getenv("USSD_METRICS_LOG", "false") == "true"
+USSD_METRICS_TOKEN = os.getenv("USSD_METRICS_TOKEN")
+
+# Carrier retries of a hop are answered from the 'ussd' cache: responses
+# are kept this many seconds, a retry waits up to USSD_RESPONSE_WAIT (just
+# under the gateway's callback timeout) for the first attempt to finish
+# before ending the session, and a claim left by a crashed worker expires
+# after USSD_RESPONSE_PENDING_TIMEOUT
+USSD_RESPONSE_CACHE_TIMEOUT = 60
+USSD_RESPONSE_WAIT = 8.0
+USSD_RESPONSE_PENDING_TIMEOUT = 10
+
+# Every hop is logged to UssdHopEvent through a per-worker buffer, written
+# once it holds USSD_HOP_EVENT_BATCH events or its oldest is
+# USSD_HOP_EVENT_FLUSH_MS old, even when no hop follows. rollup_hop_events
+# folds events older than USSD_HOP_EVENT_SETTLE seconds, when their
+# sessions are surely over, into UssdFunnelDaily, and deletes them after
+# USSD_HOP_EVENT_RETENTION days
+USSD_HOP_EVENTS = os.getenv("USSD_HOP_EVENTS", "true") == "true"
+USSD_HOP_EVENT_BATCH = 200
+USSD_HOP_EVENT_FLUSH_MS = 1000
+USSD_HOP_EVENT_SETTLE = USSD_SESSION_REAP_AFTER
+USSD_HOP_EVENT_RETENTION = 30
+
+# Flow served to each USSD service code, as dotted paths to Flow
+# instances; codes not listed get USSD_DEFAULT_FLOW, or are refused when
+# it is None
+USSD_FLOWS = {}
+USSD_DEFAULT_FLOW = 'agriassist.USSD.flows.default_flow'
+
+# Optional read replica. Only the read paths wrapped in
+# replicas.replica_reads() use it (My Bookings, menu compilation,
+# reminders and funnel reports); after a write a caller's reads stay on
+# the primary for USSD_REPLICA_PIN_SECONDS, which must exceed the
+# replica's lag
+if os.getenv("DATABASE_REPLICA_URL"):
+    DATABASES['replica'] = dj_database_url.parse(os.getenv("DATABASE_REPLICA_URL"), conn_max_age=600)
+    # tests run against one database
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['agriassist.USSD.replicas.ReplicaRouter']
+USSD_REPLICA_PIN_SECONDS = 10
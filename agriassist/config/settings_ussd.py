@@ -0,0 +1,26 @@
+"""
+Lean settings for workers that only serve the USSD endpoints.
+
+AfricasTalking's callbacks use none of the admin stack: ussd_callback is
+csrf_exempt and never touches sessions, auth or messages. This profile
+loads the USSD app alone, runs only the middleware the callback needs
+and mounts only /ussd/. Migrations, collectstatic and the admin keep
+using agriassist.config.settings.
+
+Select it with DJANGO_SETTINGS_MODULE=agriassist.config.settings_ussd.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'agriassist.USSD',
+]
+
+MIDDLEWARE = [
+    'agriassist.USSD.middleware.UssdMetricsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+]
+
+ROOT_URLCONF = 'agriassist.config.urls_ussd'
+
+TEMPLATES = []
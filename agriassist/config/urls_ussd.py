@@ -0,0 +1,9 @@
+"""
+URL configuration of the lean USSD profile (settings_ussd): the USSD
+endpoints only, without the admin.
+"""
+from django.urls import include, path
+
+urlpatterns = [
+    path('ussd/', include('agriassist.USSD.urls')),
+]